@@ -13,6 +13,14 @@
 # limitations under the License.
 
 from autopkgcmd.opts import common_parse, gen_common_parser
-from autopkgcmd.searchcmd import search_recipes
 
 __all__ = ["search_recipes", "gen_common_parser", "common_parse"]
+
+
+def __getattr__(name):
+    """Imports searchcmd, and with it the GitHub code, only when needed"""
+    if name == "search_recipes":
+        from autopkgcmd.searchcmd import search_recipes
+
+        return search_recipes
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
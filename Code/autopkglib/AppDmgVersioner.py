@@ -28,6 +28,7 @@ __all__ = ["AppDmgVersioner"]
 class AppDmgVersioner(DmgMounter):
     # we dynamically set the docstring from the description (DRY), so:
     description = "Extracts bundle ID and version of app inside dmg."
+    cacheable = True
     input_variables = {
         "dmg_path": {
             "required": True,
@@ -54,6 +54,7 @@ class FileFinder(DmgMounter):
     }
 
     description = __doc__
+    cacheable = True
 
     def globfind(self, pattern):
         """If multiple files are found the last alphanumerically sorted found
@@ -38,6 +38,7 @@ class PlistReader(DmgMounter):
     Requires version 0.2.5."""
 
     description = __doc__
+    cacheable = True
     input_variables = {
         "info_path": {
             "required": True,
@@ -34,6 +34,7 @@ class SparkleUpdateInfoProvider(URLGetter):
     """Provides URL to the highest version number or latest update."""
 
     description = __doc__
+    cache_responses = True
     input_variables = {
         "appcast_url": {
             "required": True,
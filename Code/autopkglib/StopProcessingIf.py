@@ -62,7 +62,9 @@ class StopProcessingIf(Processor):
             except Exception as err:
                 raise ProcessorError(f"Predicate error for '{predicate_string}': {err}")
 
-            result = predicate.evaluateWithObject_(self.env)
+            # the predicate is evaluated against a plain dict, since the env
+            # may be a LayeredEnv that PyObjC can't bridge to an NSDictionary
+            result = predicate.evaluateWithObject_(self.env.copy())
             self.output(f"({predicate_string}) is {result}")
             return result
         elif is_windows():  # Added on Windows version
@@ -16,15 +16,423 @@
 # limitations under the License.
 """See docstring for URLDownloader class"""
 
+import base64
+import copy
+import errno
+import hashlib
+import json
 import os.path
 import platform
+import re
+import shutil
+import subprocess
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
-from autopkglib import BUNDLE_ID, ProcessorError, xattr
+from autopkglib import (
+    BUNDLE_ID,
+    ProcessorError,
+    atomic_write,
+    get_pref,
+    get_run_id,
+    is_concurrent_run,
+    is_mac,
+    is_windows,
+    log_err,
+    xattr,
+)
+from autopkglib.transport import curl_slot
 from autopkglib.URLGetter import URLGetter
 
 __all__ = ["URLDownloader"]
 
+# Interrupted downloads are kept under the download's pathname with this
+# suffix, so that the next attempt can resume them.
+PARTIAL_SUFFIX = ".partial"
+# Segmented downloads use no more segments than give each one this many bytes
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+# ioctl that clones a file on Linux filesystems that support it
+FICLONE = 0x40049409
+# The shared download store lives in this subdirectory of CACHE_DIR
+DOWNLOAD_STORE_DIRNAME = "download_store"
+DEFAULT_DOWNLOAD_STORE_SIZE_MB = 20 * 1024
+# Downloads are coordinated between processes through claim files in this
+# subdirectory of CACHE_DIR
+DOWNLOAD_CLAIMS_DIRNAME = "download_claims"
+
+
+def clone_file(source, destination) -> bool:
+    """Make destination a copy-on-write clone of source if the filesystem
+    supports it (APFS, Btrfs, XFS), so that the two share blocks until one
+    is written to. Return False if it couldn't be cloned."""
+    try:
+        if is_mac():
+            import ctypes
+
+            libc = ctypes.CDLL(None, use_errno=True)
+            return (
+                libc.clonefile(
+                    os.fsencode(source), os.fsencode(destination), ctypes.c_int(0)
+                )
+                == 0
+            )
+        if platform.system() == "Linux":
+            import fcntl
+
+            with open(source, "rb") as src, open(destination, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+    except (OSError, AttributeError):
+        if os.path.exists(destination):
+            os.remove(destination)
+    return False
+
+
+def copy_download(source, destination, mode=None):
+    """Make destination a copy of source, with its xattrs, replacing it
+    atomically. Copies are cloned where the filesystem supports it. mode
+    sets the copy's permissions."""
+    temp_path = destination + ".copy"
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    try:
+        if not clone_file(source, temp_path):
+            shutil.copyfile(source, temp_path)
+        for name in xattr.listxattr(source):
+            value = xattr.getxattr(source, name)
+            if value is not None:
+                xattr.setxattr(temp_path, name, value)
+        if mode is not None:
+            os.chmod(temp_path, mode)
+        os.replace(temp_path, destination)
+    except BaseException:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class DownloadStore:
+    """A content-addressed store of downloads shared by all recipes, so that
+    an item fetched by several recipes (e.g. the .download, .munki and .pkg
+    variants of a recipe) is downloaded and stored once.
+
+    Items are stored read-only under objects/ by SHA-256, along with the
+    xattrs holding their ETag and Last-Modified. A recipe that hasn't
+    downloaded an item yet gets its own copy, cloned where the filesystem
+    allows, and revalidates it with a conditional request. Copies rather
+    than hardlinks keep recipes, and processors that change their items in
+    place, from changing the store or each other's items. urls/ maps each
+    URL to the object last downloaded from it and when it was last used;
+    once per run, the least recently used objects are removed until the
+    store is no larger than max_bytes."""
+
+    def __init__(self, store_dir, max_bytes):
+        self.store_dir = store_dir
+        self.max_bytes = max_bytes
+        self._collected = False
+
+    def object_path(self, sha256):
+        return os.path.join(self.store_dir, "objects", sha256[:2], sha256)
+
+    def _url_path(self, url, request_headers):
+        key = json.dumps([url, sorted((request_headers or {}).items())])
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.store_dir, "urls", digest + ".json")
+
+    def lookup(self, url, request_headers=None) -> Optional[str]:
+        """Return the path of the object last downloaded from url, or None."""
+        try:
+            with open(self._url_path(url, request_headers)) as f:
+                sha256 = json.load(f)["sha256"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        path = self.object_path(sha256)
+        return path if os.path.isfile(path) else None
+
+    def add(self, url, request_headers, pathname, sha256):
+        """Record the file at pathname, just downloaded from url, in the
+        store."""
+        try:
+            object_path = self.object_path(sha256)
+            if not os.path.exists(object_path):
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                copy_download(pathname, object_path, mode=0o444)
+            self._write_url(url, request_headers, sha256)
+            if not self._collected:
+                self._collected = True
+                self.collect_garbage()
+        except OSError as err:
+            log_err(f"WARNING: Could not add {pathname} to download store: {err}")
+
+    def touch(self, url, request_headers, sha256):
+        """Note that the object for url was used by this run."""
+        try:
+            self._write_url(url, request_headers, sha256)
+        except OSError as err:
+            log_err(f"WARNING: Could not update download store: {err}")
+
+    def _write_url(self, url, request_headers, sha256):
+        record = {"url": url, "sha256": sha256, "used": time.time()}
+        atomic_write(
+            self._url_path(url, request_headers),
+            lambda f: json.dump(record, f),
+            binary=False,
+        )
+
+    def collect_garbage(self):
+        """Remove the least recently used objects, and the URLs pointing at
+        them, until the store is no larger than max_bytes. Objects still
+        hardlinked elsewhere, as stores used to do, don't count: removing
+        them wouldn't free any space."""
+        urls_dir = os.path.join(self.store_dir, "urls")
+        last_used = {}
+        url_files = {}
+        for entry in os.scandir(urls_dir):
+            try:
+                with open(entry.path) as f:
+                    record = json.load(f)
+            except (OSError, ValueError):
+                continue
+            sha256 = record.get("sha256")
+            last_used[sha256] = max(last_used.get(sha256, 0), record.get("used", 0))
+            url_files.setdefault(sha256, []).append(entry.path)
+
+        objects = []
+        total = 0
+        for prefix in os.scandir(os.path.join(self.store_dir, "objects")):
+            for entry in os.scandir(prefix.path):
+                stat = entry.stat()
+                if stat.st_nlink > 1:
+                    continue
+                total += stat.st_size
+                # Objects no URL points at go first
+                objects.append((last_used.get(entry.name, 0), entry.name, stat.st_size))
+        if total <= self.max_bytes:
+            return
+        for _, sha256, size in sorted(objects):
+            object_path = self.object_path(sha256)
+            # read-only files can't be removed on Windows
+            os.chmod(object_path, 0o644)
+            os.remove(object_path)
+            for path in url_files.get(sha256, []):
+                os.remove(path)
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+
+_download_store: Optional[DownloadStore] = None
+
+
+def get_download_store() -> Optional[DownloadStore]:
+    """Return the shared download store, or None unless it is enabled with
+    the DOWNLOAD_STORE preference. DOWNLOAD_STORE_SIZE_MB limits its size."""
+    global _download_store
+    if not get_pref("DOWNLOAD_STORE"):
+        return None
+    if _download_store is None:
+        cache_dir = get_pref("CACHE_DIR") or "~/Library/AutoPkg/Cache"
+        size_mb = get_pref("DOWNLOAD_STORE_SIZE_MB") or DEFAULT_DOWNLOAD_STORE_SIZE_MB
+        _download_store = DownloadStore(
+            os.path.join(os.path.expanduser(cache_dir), DOWNLOAD_STORE_DIRNAME),
+            int(float(size_mb) * 1024 * 1024),
+        )
+    return _download_store
+
+
+def lock_file(f, blocking=True):
+    """Take an exclusive lock on the open file f, waiting for other
+    processes to release theirs. Return False if blocking is False and
+    another process holds it."""
+    if is_windows():
+        import msvcrt
+
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError as err:
+                if err.errno not in (errno.EACCES, errno.EDEADLOCK):
+                    raise
+                if not blocking:
+                    return False
+                time.sleep(0.1)
+    import fcntl
+
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except BlockingIOError:
+        return False
+    return True
+
+
+def unlock_file(f):
+    """Release the lock on f taken by lock_file(), and close it."""
+    try:
+        if is_windows():
+            import msvcrt
+
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    finally:
+        # closing the file releases an flock
+        f.close()
+
+
+class CoalescedDownload:
+    """A download of a URL by one processor that others in the same run
+    wait for and reuse. result is set by finish()."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        # With claim files, the locked claim file and the key the result is
+        # recorded under in it
+        self.claim_file = None
+        self.claim_key = None
+
+    def finish(self, result):
+        """Publish result, a dict describing the downloaded item, or None if
+        the download failed, and wake up any waiting processors."""
+        self.result = result
+        if self.claim_file is not None:
+            try:
+                if result is not None:
+                    record = read_claims(self.claim_file)
+                    record[self.claim_key] = result
+                    self.claim_file.seek(0)
+                    self.claim_file.truncate()
+                    json.dump(
+                        {"run_id": get_run_id(), "results": record}, self.claim_file
+                    )
+                    self.claim_file.flush()
+            except (OSError, TypeError, ValueError) as err:
+                log_err(
+                    f"WARNING: Could not record download for other processes: {err}"
+                )
+            finally:
+                unlock_file(self.claim_file)
+                self.claim_file = None
+        self.event.set()
+
+    def current(self):
+        """Return True if the item is still as it was downloaded."""
+        if self.result is None:
+            return False
+        try:
+            stat = os.stat(self.result["pathname"])
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == (
+            self.result["size"],
+            self.result["mtime_ns"],
+        )
+
+
+def read_claims(f):
+    """Return the results recorded in the open claim file f during this
+    run, by key."""
+    f.seek(0)
+    try:
+        data = json.load(f)
+    except ValueError:
+        return {}
+    if not isinstance(data, dict) or data.get("run_id") != get_run_id():
+        return {}
+    return data.get("results", {})
+
+
+class DownloadCoordinator:
+    """Makes sure each URL is downloaded once per run, however many recipes
+    download it. Downloads are keyed on the URL and request headers, so
+    differently authenticated downloads of a URL are kept apart.
+
+    Processors in this process are coordinated with a lock. If claims_dir
+    is given, so are the worker processes of a run with --jobs: a processor
+    that claims a download also locks the key's claim file there, which it
+    records the result in. Other processes wait for that lock and reuse the
+    result, while downloads of other keys go ahead.
+
+    It is only used while recipes run concurrently; see main()."""
+
+    def __init__(self, claims_dir=None):
+        self.claims_dir = claims_dir
+        self._lock = threading.Lock()
+        self._downloads = {}
+
+    def claim(self, url, request_headers=None):
+        """Return (download, True) if the caller should download url and
+        then call download.finish(), or (download, False) once another
+        processor has downloaded it, waiting for that if necessary."""
+        key = (url, tuple(sorted((request_headers or {}).items())))
+        while True:
+            with self._lock:
+                download = self._downloads.get(key)
+                if download is None or (
+                    download.event.is_set() and not download.current()
+                ):
+                    download = self._downloads[key] = CoalescedDownload()
+                    break
+            download.event.wait()
+            if download.current():
+                return download, False
+        if self.claims_dir and self._claimed_elsewhere(download, key):
+            return download, False
+        return download, True
+
+    def _claimed_elsewhere(self, download, key):
+        """Wait for any other process downloading key, and return True after
+        finishing download with its result if that is still current.
+        Otherwise leave download holding the claim file's lock."""
+        digest = hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+        path = os.path.join(self.claims_dir, f"{digest}.json")
+        try:
+            os.makedirs(self.claims_dir, exist_ok=True)
+            claim_file = open(path, "a+")
+        except OSError as err:
+            log_err(
+                f"WARNING: Could not coordinate download with other processes: {err}"
+            )
+            return False
+        try:
+            lock_file(claim_file)
+            result = read_claims(claim_file).get(digest)
+        except OSError as err:
+            log_err(
+                f"WARNING: Could not coordinate download with other processes: {err}"
+            )
+            claim_file.close()
+            return False
+        download.result = result
+        if isinstance(result, dict) and download.current():
+            unlock_file(claim_file)
+            download.finish(result)
+            return True
+        download.result = None
+        download.claim_file, download.claim_key = claim_file, digest
+        return False
+
+
+_download_coordinator: Optional[DownloadCoordinator] = None
+_download_coordinator_lock = threading.Lock()
+
+
+def get_download_coordinator() -> DownloadCoordinator:
+    """Return the run-wide download coordinator, which coordinates with the
+    other processes of the run through claim files in CACHE_DIR."""
+    global _download_coordinator
+    with _download_coordinator_lock:
+        if _download_coordinator is None:
+            cache_dir = get_pref("CACHE_DIR") or "~/Library/AutoPkg/Cache"
+            _download_coordinator = DownloadCoordinator(
+                os.path.join(os.path.expanduser(cache_dir), DOWNLOAD_CLAIMS_DIRNAME)
+            )
+        return _download_coordinator
+
 
 class URLDownloader(URLGetter):
     """Downloads a URL to the specified download_dir using curl."""
@@ -59,8 +467,8 @@ class URLDownloader(URLGetter):
             "default": False,
             "required": False,
             "description": (
-                "If True, URLDownloader attempts to determine filename from HTTP "
-                "headers downloaded before the file itself. 'prefetch_filename' "
+                "If True, URLDownloader attempts to determine filename from the "
+                "HTTP headers of the download. 'prefetch_filename' "
                 "overrides 'filename' option. Filename is determined from the first "
                 "available source of information in this order:\n"
                 "\t1. Content-Disposition header\n"
@@ -92,6 +500,27 @@ class URLDownloader(URLGetter):
                 "this package or disk image."
             ),
         },
+        "COMPUTE_HASHES": {
+            "default": False,
+            "required": False,
+            "description": (
+                "If True, download_sha1 and download_md5 are computed along "
+                "with download_sha256."
+            ),
+        },
+        "download_segments": {
+            "default": 1,
+            "required": False,
+            "description": (
+                "Number of parallel range requests to download the file with, "
+                "for servers that limit the speed of each connection. The "
+                "file is downloaded with a single request if the server "
+                "doesn't support ranges, the file is too small to split or "
+                "a segment fails. Segments need the pool transport "
+                "(HTTP_TRANSPORT set to 'pool'); with curl, the file is "
+                "downloaded with a single request and a warning. Defaults to 1."
+            ),
+        },
     }
     output_variables = {
         "pathname": {"description": "Path to the downloaded file."},
@@ -105,6 +534,18 @@ class URLDownloader(URLGetter):
                 "last time it was downloaded."
             )
         },
+        "download_sha256": {
+            "description": (
+                "SHA-256 hex digest of the downloaded item, computed while "
+                "downloading it and stored with it for later runs."
+            )
+        },
+        "download_sha1": {
+            "description": "SHA-1 hex digest of the item, if COMPUTE_HASHES is set."
+        },
+        "download_md5": {
+            "description": "MD5 hex digest of the item, if COMPUTE_HASHES is set."
+        },
         "url_downloader_summary_result": {
             "description": "Description of interesting results."
         },
@@ -149,8 +590,89 @@ class URLDownloader(URLGetter):
         # Clear out a potentially zero-byte file
         self.clear_zero_file(self.env["pathname"])
         self.add_curl_headers(curl_cmd, self.produce_etag_headers(self.env["pathname"]))
+        self.add_resume_opts(curl_cmd, pathname_temporary)
         return curl_cmd
 
+    def partial_validator(self, pathname_partial):
+        """Return the ETag or Last-Modified header stored with a partial
+        download, or None if it can't be resumed."""
+        if not os.path.isfile(pathname_partial) or not os.path.getsize(
+            pathname_partial
+        ):
+            return None
+        attrs = xattr.listxattr(pathname_partial)
+        # A weak ETag can't be used to resume a download
+        if self.xattr_etag in attrs:
+            etag = xattr.getxattr(pathname_partial, self.xattr_etag).decode()
+            if not etag.startswith("W/"):
+                return etag
+        if self.xattr_last_modified in attrs:
+            return xattr.getxattr(pathname_partial, self.xattr_last_modified).decode()
+        return None
+
+    def add_resume_opts(self, curl_cmd, pathname_temporary):
+        """Add options to resume an interrupted download. If-Range makes the
+        server send the whole item instead if it has changed since."""
+        self.resume_from = 0
+        validator = self.partial_validator(pathname_temporary)
+        if validator is None:
+            return
+        self.resume_from = os.path.getsize(pathname_temporary)
+        self.output(
+            f"Resuming download of {self.env['url']} from byte {self.resume_from}"
+        )
+        curl_cmd.extend(["--continue-at", "-"])
+        self.add_curl_headers(curl_cmd, {"If-Range": validator})
+
+    def create_partial_file(self, download_dir):
+        """Return the path to download to: a partial download that can be
+        resumed, or else a new empty file."""
+        pathname_partial = self.env["pathname"] + PARTIAL_SUFFIX
+        if self.partial_validator(pathname_partial) is not None:
+            return pathname_partial
+        if os.path.exists(pathname_partial):
+            os.remove(pathname_partial)
+        with open(pathname_partial, "wb"):
+            pass
+        # Set permissions as curl would for a newly-downloaded file, see
+        # create_temp_file()
+        os.chmod(pathname_partial, 0o644)
+        return pathname_partial
+
+    def keep_partial_download(self, pathname_partial, err):
+        """Store the validator of an interrupted download with the data
+        received so far, so that the next attempt can resume it. The partial
+        file is removed if the download can't be resumed."""
+        raw_headers = getattr(err.__cause__, "stdout", None) or ""
+        if isinstance(raw_headers, bytes):
+            raw_headers = raw_headers.decode("utf-8", errors="replace")
+        header = self.parse_headers(raw_headers)
+        resumable = (
+            header["http_result_code"] in ("200", "206")
+            and (header.get("etag") or header.get("last-modified"))
+            and os.path.isfile(pathname_partial)
+            and os.path.getsize(pathname_partial) > 0
+        )
+        if not resumable:
+            if os.path.exists(pathname_partial):
+                os.remove(pathname_partial)
+            return
+        try:
+            for attr, value in (
+                (self.xattr_etag, header.get("etag")),
+                (self.xattr_last_modified, header.get("last-modified")),
+            ):
+                if value:
+                    xattr.setxattr(pathname_partial, attr, value.encode())
+        except OSError:
+            # Without xattrs there is nowhere to keep the validator
+            os.remove(pathname_partial)
+            return
+        self.output(
+            f"Keeping {os.path.getsize(pathname_partial)} bytes downloaded so far "
+            "to resume next time"
+        )
+
     def clear_vars(self):
         """Clear and initialize variables."""
         # Delete summary result if exists
@@ -161,22 +683,24 @@ class URLDownloader(URLGetter):
         if platform.platform().startswith("Linux"):
             self.xattr_etag = f"user.{BUNDLE_ID}.etag"
             self.xattr_last_modified = f"user.{BUNDLE_ID}.last-modified"
+            self.xattr_hashes = f"user.{BUNDLE_ID}.hashes"
+            self.xattr_filename = f"user.{BUNDLE_ID}.prefetched-filename"
         else:
             self.xattr_etag = f"{BUNDLE_ID}.etag"
             self.xattr_last_modified = f"{BUNDLE_ID}.last-modified"
+            self.xattr_hashes = f"{BUNDLE_ID}.hashes"
+            self.xattr_filename = f"{BUNDLE_ID}.prefetched-filename"
 
         self.env["last_modified"] = ""
         self.env["etag"] = ""
+        for name in ("sha256", "sha1", "md5"):
+            self.env.pop(f"download_{name}", None)
         self.existing_file_size = None
+        self.resume_from = 0
+        self.download_hashes = None
 
-    def prefetch_filename(self):
+    def filename_from_headers(self, header):
         """Attempt to find filename in HTTP headers."""
-        curl_cmd = self.prepare_base_curl_cmd()
-        curl_cmd.extend(["--head", "--request", "GET"])
-
-        raw_headers = self.download_with_curl(curl_cmd)
-        header = self.parse_headers(raw_headers)
-
         if "filename=" in header.get("content-disposition", ""):
             filename = (
                 header["content-disposition"]
@@ -184,24 +708,94 @@ class URLDownloader(URLGetter):
                 .replace('"', "")
             )
             self.output(
-                f"Filename prefetched from the HTTP Content-Disposition header: {filename}",
+                f"Filename found in the HTTP Content-Disposition header: {filename}",
                 verbose_level=2,
             )
         elif header.get("http_redirected", None):
             filename = header["http_redirected"].rpartition("/")[2]
             self.output(
-                f"Filename prefetched from the HTTP Location header: {filename}",
+                f"Filename found in the HTTP Location header: {filename}",
                 verbose_level=2,
             )
         else:
-            self.output(
-                "Unable to find filename in the HTTP headers during prefetch",
-                verbose_level=2,
-            )
+            self.output("Unable to find filename in the HTTP headers", verbose_level=2)
             return None
 
         return filename
 
+    def prefetch_filename(self):
+        """Return the filename found in the HTTP headers when the URL was
+        last downloaded to download_dir, or None.
+
+        The filename is only known once the download has started, so it is
+        remembered in an xattr of download_dir rather than asked for with a
+        separate request. Keeping the name lets the download itself be a
+        conditional request against the file downloaded last time. If
+        nothing is remembered but download_dir holds earlier downloads, e.g.
+        from a version that didn't remember filenames, the filename is found
+        with a separate request as it used to be, so that the item can still
+        be revalidated rather than downloaded again."""
+        download_dir = self.get_download_dir()
+        filename = self.remembered_filename(download_dir)
+        if filename is None and any(
+            entry.is_file() and not entry.name.endswith(PARTIAL_SUFFIX)
+            for entry in os.scandir(download_dir)
+        ):
+            filename = self.head_filename()
+            if filename:
+                self.store_filename(download_dir, filename)
+        return filename
+
+    def remembered_filename(self, download_dir):
+        """Return the filename remembered in download_dir for the URL, or
+        None."""
+        try:
+            # Like a stub without xattr support, ADS returns None rather than
+            # raising for a missing attribute, so check it's there first
+            if self.xattr_filename not in xattr.listxattr(download_dir):
+                return None
+            remembered = json.loads(xattr.getxattr(download_dir, self.xattr_filename))
+        except (OSError, KeyError, TypeError, ValueError):
+            return None
+        if not isinstance(remembered, dict) or remembered.get("url") != self.env["url"]:
+            return None
+        return remembered.get("filename")
+
+    def head_filename(self):
+        """Return the filename in the HTTP headers of the URL, fetched
+        without the body, or None."""
+        curl_cmd = self.prepare_base_curl_cmd()
+        curl_cmd.extend(["--head", "--request", "GET"])
+        raw_headers = self.download_with_curl(curl_cmd)
+        return self.filename_from_headers(self.parse_headers(raw_headers))
+
+    def remember_filename(self, header):
+        """Rename the download after the filename in its HTTP headers, and
+        remember it for prefetch_filename next time."""
+        filename = self.filename_from_headers(header)
+        if not filename:
+            return
+        self.env["pathname"] = os.path.join(
+            os.path.dirname(self.env["pathname"]), filename
+        )
+        self.store_filename(os.path.dirname(self.env["pathname"]), filename)
+
+    def store_filename(self, download_dir, filename):
+        """Remember filename as the URL's in an xattr of download_dir."""
+        remembered = {"url": self.env["url"], "filename": filename}
+        try:
+            # ADS won't replace an existing stream
+            if self.xattr_filename in xattr.listxattr(download_dir):
+                xattr.removexattr(download_dir, self.xattr_filename)
+            xattr.setxattr(
+                download_dir, self.xattr_filename, json.dumps(remembered).encode()
+            )
+        except (OSError, TypeError, ValueError) as err:
+            # Not every backend can set attributes on a directory; the file
+            # is still named after the headers, only next run can't make a
+            # conditional request without asking for them first
+            self.output(f"WARNING: Could not remember filename: {err}")
+
     def get_filename(self):
         """Obtain filename from PKG variable or URL."""
         if "PKG" in self.env:
@@ -312,6 +906,376 @@ class URLDownloader(URLGetter):
             )
             self.output(f"Storing new ETag header: {header.get('etag')}")
 
+    def download_resumable(self, curl_cmd, pathname_temporary, download_dir):
+        """Execute the download curl command and return the parsed headers.
+        If a partial download can't be resumed, download all of it."""
+        try:
+            raw_headers = self.download_with_curl(curl_cmd)
+        except ProcessorError as err:
+            if not self.resume_from or not re.search(r"\(33\)|error: 416", str(err)):
+                self.keep_partial_download(pathname_temporary, err)
+                raise
+            # The server can't resume this download, e.g. because the item
+            # has changed since, so fetch all of it
+            self.output("Unable to resume download, starting over")
+            os.remove(pathname_temporary)
+            pathname_temporary = self.create_partial_file(download_dir)
+            curl_cmd = self.prepare_download_curl_cmd(pathname_temporary)
+            try:
+                raw_headers = self.download_with_curl(curl_cmd)
+            except ProcessorError as err:
+                self.keep_partial_download(pathname_temporary, err)
+                raise
+        return self.parse_headers(raw_headers)
+
+    def download_segmented(self, curl_cmd, pathname_temporary):
+        """Download the item with download_segments parallel range requests
+        written into a preallocated file, and return the parsed headers.
+        Return None if it should be downloaded with a single request
+        instead."""
+        transport = self.http_transport()
+        if transport is None:
+            self.output(
+                "WARNING: download_segments requires HTTP_TRANSPORT to be 'pool', "
+                "downloading with a single request"
+            )
+            return None
+        request = transport.translate(curl_cmd)
+        if request is None:
+            self.output(
+                "Segmented download isn't possible with these curl options",
+                verbose_level=2,
+            )
+            return None
+
+        # Check the headers before downloading anything
+        probe = copy.copy(request)
+        probe.headers_only = True
+        probe.output = None
+        probe.method = "GET"
+        raw_headers = self.perform_request(transport, probe)
+        header = self.parse_headers(raw_headers.decode("utf-8", errors="replace"))
+        if header["http_result_code"] == "304":
+            return header
+        size = int(header.get("content-length") or 0)
+        if self.env["CHECK_FILESIZE_ONLY"] and size == self.existing_file_size:
+            return header
+        validator = header.get("etag")
+        if not validator or validator.startswith("W/"):
+            validator = header.get("last-modified")
+        segments = min(int(self.env["download_segments"]), size // MIN_SEGMENT_SIZE)
+        if (
+            header["http_result_code"] != "200"
+            or header.get("accept-ranges", "").lower() != "bytes"
+            or not validator
+            or segments < 2
+        ):
+            self.output(
+                "Server can't do a segmented download of this item",
+                verbose_level=2,
+            )
+            return None
+
+        with open(pathname_temporary, "wb") as f:
+            f.truncate(size)
+        segment_requests = []
+        for index in range(segments):
+            start = index * size // segments
+            end = (index + 1) * size // segments - 1
+            segment = copy.copy(request)
+            segment.headers = [
+                (name, value)
+                for name, value in request.headers
+                if name.lower() not in ("if-none-match", "if-modified-since")
+            ]
+            # If-Range makes the server send a 200 instead of mixing parts of
+            # two versions of the item, which fails the segment
+            segment.headers.extend(
+                [("Range", f"bytes={start}-{end}"), ("If-Range", validator)]
+            )
+            segment.dump_header = None
+            segment.fail = True
+            segment.output_offset = start
+            segment_requests.append((segment, end - start + 1))
+        self.output(f"Downloading {size} bytes in {segments} segments")
+        with ThreadPoolExecutor(max_workers=segments) as executor:
+            futures = [
+                executor.submit(transport.perform, segment)
+                for segment, _ in segment_requests
+            ]
+            errors = [future.exception() for future in futures if future.exception()]
+
+        for segment, length in segment_requests:
+            if not errors and segment.size_downloaded != length:
+                errors.append(
+                    f"expected {length} bytes, received {segment.size_downloaded}"
+                )
+        if not errors and not self.download_matches_digest(header, pathname_temporary):
+            errors.append("the file doesn't match the digest sent by the server")
+        if errors:
+            error = errors[0]
+            self.output(
+                "WARNING: Segmented download failed "
+                f"({getattr(error, 'stderr', str(error)).strip()}), "
+                "downloading with a single request"
+            )
+            with open(pathname_temporary, "wb"):
+                pass
+            return None
+        return header
+
+    def download_matches_digest(self, header, pathname):
+        """Check a download against a Content-MD5 or Digest header, if the
+        server sent either. Return False if it doesn't match."""
+        expected = []
+        if header.get("content-md5"):
+            expected.append(("md5", header["content-md5"].strip()))
+        for item in header.get("digest", "").split(","):
+            algorithm, _, value = item.strip().partition("=")
+            if algorithm.lower() in ("md5", "sha-256"):
+                expected.append((algorithm.lower().replace("-", ""), value))
+        if not expected:
+            return True
+        hashes = {algorithm: hashlib.new(algorithm) for algorithm, _ in expected}
+        with open(pathname, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                for a_hash in hashes.values():
+                    a_hash.update(chunk)
+        return all(
+            base64.b64encode(hashes[algorithm].digest()).decode() == value
+            for algorithm, value in expected
+        )
+
+    def new_download_hashes(self):
+        """Return a dict of new hashlib objects for the hashes to compute."""
+        names = ["sha256"]
+        if self.env.get("COMPUTE_HASHES"):
+            names.extend(["sha1", "md5"])
+        return {name: hashlib.new(name) for name in names}
+
+    def hash_file(self, pathname, hashes=None):
+        """Update hashes, or new download hashes, with the contents of the
+        file at pathname and return them."""
+        if hashes is None:
+            hashes = self.new_download_hashes()
+        with open(pathname, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                for a_hash in hashes.values():
+                    a_hash.update(chunk)
+        return hashes
+
+    def perform_request(self, transport, request):
+        """Hash the download as it is written, so that the file doesn't have
+        to be read again afterwards."""
+        if (
+            request.output == self.env.get("pathname", "") + PARTIAL_SUFFIX
+            and not request.headers_only
+            and request.output_offset is None
+        ):
+            hashes = self.new_download_hashes()
+            if request.continue_at is not None and os.path.isfile(request.output):
+                # Resuming, so start with the bytes we already have
+                self.hash_file(request.output, hashes)
+            request.hashes = list(hashes.values())
+            self.download_hashes = hashes
+        return super().perform_request(transport, request)
+
+    def execute_curl(self, curl_cmd, text=True):
+        """Run a download that the HTTP transport doesn't perform with curl
+        writing the item to a pipe, and hash it as it is written to the
+        partial file, as perform_request() does for the transport."""
+        pathname_partial = self.env.get("pathname", "") + PARTIAL_SUFFIX
+        transport = self.http_transport()
+        if (
+            "--output" not in curl_cmd
+            or curl_cmd[curl_cmd.index("--output") + 1] != pathname_partial
+            or (transport is not None and transport.translate(curl_cmd) is not None)
+        ):
+            return super().execute_curl(curl_cmd, text)
+        raw_headers = self.stream_download(curl_cmd, pathname_partial)
+        if text:
+            raw_headers = raw_headers.decode("utf-8", errors="replace")
+        return raw_headers, "", 0
+
+    def stream_download(self, curl_cmd, pathname_partial):
+        """Run the download curl_cmd with the item sent to stdout instead,
+        write it to pathname_partial while hashing it, and return the
+        headers curl received."""
+        hashes = self.new_download_hashes()
+        resuming = "--continue-at" in curl_cmd
+        if resuming:
+            # Start with the bytes we already have
+            self.hash_file(pathname_partial, hashes)
+        header_fd, header_path = tempfile.mkstemp(suffix=".headers")
+        os.close(header_fd)
+        replaced = {
+            "--output": "-",
+            "--dump-header": header_path,
+            # curl can't tell where to continue when writing to stdout
+            "--continue-at": str(os.path.getsize(pathname_partial)),
+        }
+        stream_cmd = []
+        args = iter(curl_cmd)
+        for arg in args:
+            stream_cmd.append(arg)
+            if arg in replaced:
+                next(args, None)
+                stream_cmd.append(replaced[arg])
+        stream_cmd = self.add_curl_retry_opts(stream_cmd)
+        received = 0
+        try:
+            with open(pathname_partial, "ab" if resuming else "wb") as f:
+                start = f.tell()
+                with tempfile.TemporaryFile() as stderr_file, curl_slot(
+                    self.curl_host(stream_cmd)
+                ):
+                    with subprocess.Popen(
+                        stream_cmd, stdout=subprocess.PIPE, stderr=stderr_file
+                    ) as proc:
+                        for chunk in iter(lambda: proc.stdout.read(1024 * 1024), b""):
+                            f.write(chunk)
+                            for a_hash in hashes.values():
+                                a_hash.update(chunk)
+                            received += len(chunk)
+                    stderr_file.seek(0)
+                    stderr = stderr_file.read().decode("utf-8", errors="replace")
+                with open(header_path, "rb") as header_file:
+                    raw_headers = header_file.read()
+                header = self.parse_headers(raw_headers.decode("utf-8", "replace"))
+                length = header.get("content-length", "")
+                if (
+                    proc.returncode == 0
+                    and header["http_result_code"] in ("200", "206")
+                    and length.isdigit()
+                    and int(length) != received
+                ):
+                    # e.g. curl retried a transfer it had already written
+                    # part of, so throw away what this attempt received
+                    f.truncate(start)
+                    raise ProcessorError(
+                        f"curl failure: received {received} bytes, expected {length}"
+                    )
+        finally:
+            os.remove(header_path)
+        if proc.returncode:
+            self.output(f"ERROR: {stderr.removeprefix('curl: ')}")
+            raise ProcessorError(stderr) from subprocess.CalledProcessError(
+                proc.returncode, stream_cmd, raw_headers, stderr
+            )
+        self.download_hashes = hashes
+        return raw_headers
+
+    def stored_hashes(self):
+        """Return the hashes stored with the downloaded item, or None if
+        there are none or they don't match the file as it is now."""
+        pathname = self.env["pathname"]
+        try:
+            if self.xattr_hashes not in xattr.listxattr(pathname):
+                return None
+            stored = json.loads(xattr.getxattr(pathname, self.xattr_hashes))
+            stat = os.stat(pathname)
+        except (OSError, ValueError):
+            return None
+        if (stored.get("size"), stored.get("mtime_ns")) != (
+            stat.st_size,
+            stat.st_mtime_ns,
+        ):
+            return None
+        wanted = self.new_download_hashes().keys()
+        if not all(stored.get(name) for name in wanted):
+            return None
+        return {name: stored[name] for name in wanted}
+
+    def store_hashes(self, digests):
+        """Store hex digests of the downloaded item in its xattrs, along with
+        the size and modification time they belong to."""
+        pathname = self.env["pathname"]
+        stat = os.stat(pathname)
+        stored = dict(digests, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        xattr.setxattr(pathname, self.xattr_hashes, json.dumps(stored).encode())
+
+    def output_hashes(self, downloaded):
+        """Set the download_* hash output variables. A new download's hashes
+        were usually computed while downloading it; an existing item's are
+        read from its xattrs if possible."""
+        digests = None if downloaded else self.stored_hashes()
+        if digests is None:
+            hashes = self.download_hashes if downloaded else None
+            if hashes is None:
+                hashes = self.hash_file(self.env["pathname"])
+            digests = {name: a_hash.hexdigest() for name, a_hash in hashes.items()}
+            self.store_hashes(digests)
+        for name, digest in digests.items():
+            self.env[f"download_{name}"] = digest
+
+    def copy_from_store(self, store):
+        """If this recipe hasn't downloaded the item yet but another recipe
+        has, copy the stored item into place so that it can be revalidated
+        instead of downloaded. Return True if it was copied."""
+        pathname = self.env["pathname"]
+        if os.path.exists(pathname):
+            return False
+        object_path = store.lookup(self.env["url"], self.env.get("request_headers"))
+        if object_path is None:
+            return False
+        try:
+            copy_download(object_path, pathname, mode=0o644)
+        except OSError as err:
+            self.output(f"WARNING: Could not use the download store: {err}")
+            return False
+        self.output(f"Found {self.env['url']} in the download store", verbose_level=2)
+        return True
+
+    def coalesced_result(self):
+        """Describe the item at pathname for other processors downloading
+        the same URL in this run."""
+        stat = os.stat(self.env["pathname"])
+        return {
+            "pathname": self.env["pathname"],
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": self.env["download_sha256"],
+            "etag": self.getxattr(self.xattr_etag),
+            "last_modified": self.getxattr(self.xattr_last_modified),
+        }
+
+    def reuse_download(self, result):
+        """Use an item another processor downloaded from the same URL
+        earlier in this run instead of downloading it again."""
+        if self.env.get("prefetch_filename", False):
+            self.env["pathname"] = os.path.join(
+                os.path.dirname(self.env["pathname"]),
+                os.path.basename(result["pathname"]),
+            )
+        pathname = self.env["pathname"]
+        if os.path.exists(pathname):
+            self.output_hashes(downloaded=False)
+            if self.env["download_sha256"] == result["sha256"]:
+                self.env["download_changed"] = False
+                self.output("Item at URL is unchanged.")
+                self.output(f"Using existing {pathname}")
+                return
+        try:
+            copy_download(result["pathname"], pathname)
+        except OSError as err:
+            raise ProcessorError(
+                f"Can't copy {result['pathname']} to {pathname}: {err}"
+            )
+        for name, attr in (
+            ("etag", self.xattr_etag),
+            ("last_modified", self.xattr_last_modified),
+        ):
+            if result[name]:
+                self.env[name] = result[name]
+                xattr.setxattr(pathname, attr, result[name].encode())
+        self.output_hashes(downloaded=False)
+        self.env["download_changed"] = True
+        self.output(f"Using {pathname}, downloaded from the same URL in this run")
+        self.env["url_downloader_summary_result"] = {
+            "summary_text": "The following new items were downloaded:",
+            "data": {"download_path": pathname},
+        }
+
     def main(self):
         # Clear and initiazize data structures
         self.clear_vars()
@@ -322,27 +1286,81 @@ class URLDownloader(URLGetter):
             return
         download_dir = self.get_download_dir()
         self.env["pathname"] = os.path.join(download_dir, filename)
-        pathname_temporary = self.create_temp_file(download_dir)
+
+        if not is_concurrent_run():
+            # Recipes run one at a time each revalidate their own download
+            self.download_item(download_dir)
+            return
+
+        # Download each URL once per run, however many recipes use it at once
+        download, first = get_download_coordinator().claim(
+            self.env["url"], self.env.get("request_headers")
+        )
+        if not first:
+            self.reuse_download(download.result)
+            return
+        result = None
+        try:
+            self.download_item(download_dir)
+            result = self.coalesced_result()
+        finally:
+            download.finish(result)
+
+    def download_item(self, download_dir):
+        """Download the item to pathname unless it is unchanged."""
+        store = get_download_store()
+        from_store = store is not None and self.copy_from_store(store)
+        pathname_temporary = self.create_partial_file(download_dir)
 
         # Prepare curl command
         curl_cmd = self.prepare_download_curl_cmd(pathname_temporary)
 
-        # Execute curl command and parse headers
-        raw_headers = self.download_with_curl(curl_cmd)
-        header = self.parse_headers(raw_headers)
+        header = None
+        if int(self.env.get("download_segments") or 1) > 1 and not self.resume_from:
+            header = self.download_segmented(curl_cmd, pathname_temporary)
+        if header is None:
+            header = self.download_resumable(curl_cmd, pathname_temporary, download_dir)
 
         if self.download_changed(header):
             self.env["download_changed"] = True
+        elif from_store:
+            # The stored copy is current, and new to this recipe
+            os.remove(pathname_temporary)
+            self.output_hashes(downloaded=False)
+            self.env["download_changed"] = True
+            store.touch(
+                self.env["url"],
+                self.env.get("request_headers"),
+                self.env["download_sha256"],
+            )
+            self.output(f"Using {self.env['pathname']} from the download store")
+            self.env["url_downloader_summary_result"] = {
+                "summary_text": "The following new items were downloaded:",
+                "data": {"download_path": self.env["pathname"]},
+            }
+            return
         else:
             # Discard the temp file
             os.remove(pathname_temporary)
+            self.output_hashes(downloaded=False)
             return
 
+        if self.env.get("prefetch_filename", False):
+            self.remember_filename(header)
+
         # New resource was downloaded. Move the temporary download file to the pathname
         self.move_temp_file(pathname_temporary)
 
         # Save last-modified and etag headers to files xattr
         self.store_headers(header)
+        self.output_hashes(downloaded=True)
+        if store is not None:
+            store.add(
+                self.env["url"],
+                self.env.get("request_headers"),
+                self.env["pathname"],
+                self.env["download_sha256"],
+            )
 
         # Generate output messages and variables
         self.output(f"Downloaded {self.env['pathname']}")
@@ -19,7 +19,8 @@ import json
 import os
 import ssl
 from hashlib import md5, sha1, sha256
-from urllib.request import urlopen
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 
 import certifi
 from autopkglib.URLDownloader import URLDownloader
@@ -238,7 +239,54 @@ class URLDownloaderPython(URLDownloader):
         # https://stackoverflow.com/questions/24374400/verifying-https-certificates-with-urllib-request
         return ssl.create_default_context(cafile=certifi.where())
 
-    def download_and_hash(self, file_save_path):
+    def conditional_headers(self):
+        """Return If-None-Match and If-Modified-Since headers for a previous
+        download, taken from its .info.json or, failing that, its xattrs."""
+        pathname = self.env.get("pathname")
+        if not pathname or not os.path.isfile(pathname):
+            return {}
+        previous_headers = {}
+        if os.path.isfile(pathname + ".info.json"):
+            previous_download_info = self.get_download_info_json() or {}
+            previous_headers = previous_download_info.get("http_headers") or {}
+        if previous_headers.get("ETag") or previous_headers.get("Last-Modified"):
+            headers = {}
+            if previous_headers.get("ETag"):
+                headers["If-None-Match"] = previous_headers["ETag"]
+            if previous_headers.get("Last-Modified"):
+                headers["If-Modified-Since"] = previous_headers["Last-Modified"]
+            return headers
+        try:
+            return self.produce_etag_headers(pathname)
+        except OSError:
+            # xattrs aren't available on every filesystem
+            return {}
+
+    def open_url(self):
+        """Request the url, sending conditional headers for a previous
+        download. Return the response if the item must be downloaded, or None
+        if it is unchanged, in which case the body is never read."""
+        request = Request(self.env.get("url"), headers=self.conditional_headers())
+        try:
+            response = urlopen(request, context=self.ssl_context_certifi())
+        except HTTPError as err:
+            if err.code != 304:
+                raise
+            err.close()
+            self.env["download_changed"] = False
+            self.output("Item at URL is unchanged.")
+            self.output(f"Using existing {self.env['pathname']}")
+            return None
+
+        self.env["download_changed"] = self.download_changed(response.info())
+        # check if download changed from last run:
+        if not self.env.get("download_changed", None):
+            # Drop the connection rather than reading the body
+            response.close()
+            return None
+        return response
+
+    def download_and_hash(self, file_save_path, response=None):
         """stream down file from url and calculate size & hashes"""
         # it is much more efficient to calculate hashes WHILE downloading
         # this allows the file to be read only once and never from disk
@@ -260,22 +308,20 @@ class URLDownloaderPython(URLDownloader):
 
         size = 0
 
+        # get http headers, unless the caller already has
+        if response is None:
+            response = self.open_url()
+            if response is None:
+                # Discard the temp file
+                if file_save_path and os.path.exists(file_save_path):
+                    os.remove(file_save_path)
+                return None
+
         file_save = None
 
         if file_save_path:
             file_save = open(file_save_path, "wb")
 
-        # get http headers
-        response = urlopen(url, context=self.ssl_context_certifi())
-        response_headers = response.info()
-
-        self.env["download_changed"] = self.download_changed(response_headers)
-        # check if download changed from last run:
-        if not self.env.get("download_changed", None):
-            # Discard the temp file
-            os.remove(file_save_path)
-            return None
-
         # download file
         while True:
             chunk = response.read(chunksize)
@@ -367,10 +413,15 @@ class URLDownloaderPython(URLDownloader):
         if self.env.get("CHECK_FILESIZE_ONLY", None):
             self.env["HEADERS_TO_TEST"] = ["Content-Length"]
 
+        # check for changes before creating anything on disk
+        response = self.open_url()
+        if response is None:
+            return
+
         pathname_temporary = self.create_temp_file(download_dir)
 
         # download file
-        download_dictionary = self.download_and_hash(pathname_temporary)
+        download_dictionary = self.download_and_hash(pathname_temporary, response)
 
         self.output(
             "download_dictionary: \n{download_dictionary}\n".format(
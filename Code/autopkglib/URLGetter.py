@@ -17,17 +17,39 @@
 """See docstring for URLGetter class"""
 
 import os.path
+import re
 import subprocess
+from urllib.parse import urlsplit
 
-from autopkglib import Processor, ProcessorError, find_binary, is_windows
+from autopkglib import Processor, ProcessorError, find_binary, get_pref, is_windows
+from autopkglib.transport import (
+    DEFAULT_RETRIES,
+    DEFAULT_RETRY_MAX_WAIT,
+    TransportError,
+    curl_slot,
+    get_rate_limiter,
+    get_response_cache,
+    get_transport,
+    numeric_pref,
+    parse_curl_cmd,
+)
 
 __all__ = ["URLGetter"]
 
+# Appended to curl's stdout by --write-out, followed by the response status,
+# when a response is to be cached
+CURL_STATUS_MARKER = b"\n--autopkg-http-status--"
+
 
 class URLGetter(Processor):
     """Handles curl HTTP operations. Serves only as superclass. Not for direct use."""
 
     description = __doc__
+    # Subclasses that fetch the same small documents across recipes (feeds,
+    # web pages, API responses) set this to share responses for the whole
+    # run, whether they are made by curl or the pool transport. Downloads of
+    # the items themselves are never cached.
+    cache_responses = False
 
     def __init__(self, env=None, infile=None, outfile=None):
         super().__init__(env, infile, outfile)
@@ -51,10 +73,11 @@ class URLGetter(Processor):
 
     def prepare_curl_cmd(self):
         """Assemble basic curl command and return it."""
-        if is_windows() and "windows\\system32" in self.curl_binary().lower():
+        curlbin = self.curl_binary()
+        if is_windows() and "windows\\system32" in curlbin.lower():
             # if using windows default curl, --compressed is not supported
-            return [self.curl_binary(), "--location"]
-        return [self.curl_binary(), "--compressed", "--location"]
+            return [curlbin, "--location"]
+        return [curlbin, "--compressed", "--location"]
 
     def add_curl_headers(self, curl_cmd, headers):
         """Add headers to curl_cmd."""
@@ -166,19 +189,153 @@ class URLGetter(Processor):
                     self.clear_header(header)
         return header
 
-    def execute_curl(self, curl_cmd, text=True):
-        """Execute curl command. Return stdout, stderr and return code."""
-        try:
-            result = subprocess.run(
-                curl_cmd,
-                shell=False,
-                capture_output=True,
-                check=True,
-                text=text,
+    def http_transport(self):
+        """Return the in-process transport used for curl commands, or None to
+        always run curl. Chosen by env['HTTP_TRANSPORT'] or the app pref
+        'HTTP_TRANSPORT': 'curl' (the default) or 'pool'.
+
+        The pool transport only honours proxies set in the environment and
+        ignores ~/.curlrc, so it is opt-in. Response caching, retries, rate
+        and per-host limits and hashing downloads as they are written work
+        with either; keep-alive connections and URLDownloader's
+        download_segments need the pool."""
+        name = self.env.get("HTTP_TRANSPORT") or get_pref("HTTP_TRANSPORT") or "curl"
+        if name == "curl":
+            return None
+        transport = get_transport(name)
+        if transport is None:
+            self.output(
+                f"WARNING: Unknown HTTP_TRANSPORT '{name}', using curl.",
+                verbose_level=2,
             )
-        except subprocess.CalledProcessError as e:
+        return transport
+
+    def perform_request(self, transport, request):
+        """Perform a request translated from a curl command with transport,
+        or answer it from the run-wide response cache. Return what curl would
+        have written to stdout."""
+        cache = get_response_cache() if self.cache_responses else None
+        stdout = cache.get(request) if cache else None
+        if stdout is not None:
+            self.output(f"Using cached response for {request.url}", verbose_level=3)
+            return stdout
+        self.output(
+            f"Performing {request.method} {request.url} in-process", verbose_level=4
+        )
+        try:
+            stdout = transport.perform(request)
+        except TransportError as e:
             self.output(f"ERROR: {e.stderr.removeprefix('curl: ')}")
             raise ProcessorError(e.stderr) from e
+        if cache:
+            cache.put(request, stdout)
+        return stdout
+
+    @staticmethod
+    def curl_method(curl_cmd):
+        """Return the HTTP method curl_cmd sends."""
+        method = "GET"
+        args = iter(curl_cmd[1:])
+        for arg in args:
+            if arg in ("-X", "--request"):
+                return next(args, method).upper()
+            if arg in ("-I", "--head"):
+                method = "HEAD"
+            elif arg in ("-T", "--upload-file"):
+                method = "PUT"
+            elif arg in ("-d", "-F", "--form", "--json") or arg.startswith("--data"):
+                method = "POST"
+        return method
+
+    @staticmethod
+    def curl_host(curl_cmd):
+        """Return the host of the HTTP(S) URL curl_cmd requests, or None."""
+        urls = [arg for arg in curl_cmd if re.match(r"https?://", arg, re.I)]
+        return urlsplit(urls[-1]).hostname if urls else None
+
+    def add_curl_retry_opts(self, curl_cmd):
+        """Wait for the per-host rate limiter before running curl, and have
+        curl retry GET and HEAD requests that are turned away with 429 or a
+        temporary server error, HTTP_RETRIES times (3 by default) for up to
+        HTTP_RETRY_MAX_WAIT seconds (60 by default). Other requests may have
+        taken effect, so aren't retried. Return the command to run.
+
+        The rate limiter is shared by the recipes run in a process, so with
+        --jobs each worker process sends up to HTTP_RATE_LIMIT requests per
+        second to a host."""
+        host = self.curl_host(curl_cmd)
+        if host:
+            get_rate_limiter().acquire(host)
+        if "--retry" in curl_cmd or self.curl_method(curl_cmd) not in ("GET", "HEAD"):
+            return curl_cmd
+        retries = numeric_pref("HTTP_RETRIES", DEFAULT_RETRIES, int)
+        if not retries:
+            return curl_cmd
+        max_wait = numeric_pref("HTTP_RETRY_MAX_WAIT", DEFAULT_RETRY_MAX_WAIT, int)
+        return [
+            curl_cmd[0],
+            "--retry",
+            str(retries),
+            "--retry-max-time",
+            str(max_wait),
+        ] + curl_cmd[1:]
+
+    def run_curl(self, curl_cmd, text=True):
+        """Run curl_cmd and return its CompletedProcess. Like the pool
+        transport's connections, no more than HTTP_MAX_CONNECTIONS_PER_HOST
+        curl processes run against a host at once."""
+        curl_cmd = self.add_curl_retry_opts(curl_cmd)
+        try:
+            with curl_slot(self.curl_host(curl_cmd)):
+                return subprocess.run(
+                    curl_cmd,
+                    shell=False,
+                    capture_output=True,
+                    check=True,
+                    text=text,
+                )
+        except subprocess.CalledProcessError as e:
+            stderr = e.stderr if text else e.stderr.decode("utf-8", "replace")
+            self.output(f"ERROR: {stderr.removeprefix('curl: ')}")
+            raise ProcessorError(stderr) from e
+
+    def run_cached_curl(self, curl_cmd, request, cache):
+        """Run curl_cmd, described by request, or answer it from the run-wide
+        response cache, and return what curl wrote to stdout."""
+        stdout = cache.get(request)
+        if stdout is not None:
+            self.output(f"Using cached response for {request.url}", verbose_level=3)
+            return stdout
+        status_format = CURL_STATUS_MARKER.decode() + "%{http_code}"
+        result = self.run_curl(curl_cmd + ["--write-out", status_format], text=False)
+        stdout, _, status = result.stdout.rpartition(CURL_STATUS_MARKER)
+        if status.isdigit():
+            request.status = int(status)
+            cache.put(request, stdout)
+        return stdout
+
+    def execute_curl(self, curl_cmd, text=True):
+        """Execute curl command. Return stdout, stderr and return code.
+
+        Commands the HTTP transport can reproduce are performed in-process
+        over pooled keep-alive connections; anything else runs curl. Either
+        way, processors that cache responses reuse those to the same
+        requests."""
+        transport = self.http_transport()
+        request = transport.translate(curl_cmd) if transport else None
+        if request is not None:
+            stdout = self.perform_request(transport, request)
+            if text:
+                stdout = stdout.decode("utf-8", errors="replace")
+            return stdout, "", 0
+        cache = get_response_cache() if self.cache_responses else None
+        request = parse_curl_cmd(curl_cmd) if cache else None
+        if request is not None and cache.key(request) is not None:
+            stdout = self.run_cached_curl(curl_cmd, request, cache)
+            if text:
+                stdout = stdout.decode("utf-8", errors="replace")
+            return stdout, "", 0
+        result = self.run_curl(curl_cmd, text)
         return result.stdout, result.stderr, result.returncode
 
     def download_with_curl(self, curl_cmd, text=True):
@@ -83,6 +83,7 @@ class URLTextSearcher(URLGetter):
     }
 
     description = __doc__
+    cache_responses = True
 
     def prepare_curl_cmd(self):
         """Assemble curl command and return it."""
@@ -57,6 +57,7 @@ class Unarchiver(Processor):
     """Archive decompressor for zip and common tar-compressed formats."""
 
     description = __doc__
+    cacheable = True
     input_variables = {
         "archive_path": {
             "required": False,
@@ -165,6 +166,15 @@ class Unarchiver(Processor):
                 f"{stderr}"
             )
 
+    def cache_paths(self):
+        """The archive and destination, which may come from defaults."""
+        paths = [self.env.get("archive_path", self.env.get("pathname"))]
+        if "destination_path" in self.env:
+            paths.append(self.env["destination_path"])
+        elif "RECIPE_CACHE_DIR" in self.env and "NAME" in self.env:
+            paths.append(os.path.join(self.env["RECIPE_CACHE_DIR"], self.env["NAME"]))
+        return [path for path in paths if path]
+
     def main(self):
         """Unarchive a file"""
         # handle some defaults for archive_path and destination_path
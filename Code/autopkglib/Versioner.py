@@ -41,6 +41,7 @@ class Versioner(DmgMounter):
     """Returns version information from a plist"""
 
     description = __doc__
+    cacheable = True
 
     input_variables = {
         "input_plist_path": {
@@ -15,23 +15,39 @@
 # limitations under the License.
 
 """Core/shared autopkglib functions"""
+import ast
 import glob
+import hashlib
 import imp
+import importlib
+import importlib.resources
 import json
+import marshal
 import os
 import plistlib
 import pprint
 import re
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import traceback
+import types
+import uuid
+from collections.abc import MutableMapping
 from copy import deepcopy
 from distutils.version import LooseVersion
-from typing import IO, Any, Dict, List, Optional, Union
+from typing import IO, Any, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlsplit
 
 import appdirs
-import pkg_resources
-import yaml
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
 
 # Type for methods that accept either a filesystem path or a file-like object.
 FileOrPath = Union[IO, str, bytes, int]
@@ -123,6 +139,14 @@ RE_KEYREF = re.compile(r"%(?P<key>[a-zA-Z_][a-zA-Z_0-9]*)%")
 # Supported recipe extensions
 RECIPE_EXTS = (".recipe", ".recipe.plist", ".recipe.yaml")
 
+# Parsed yaml recipes are cached in this subdirectory of CACHE_DIR, keyed by
+# the sha256 hash of the recipe file. marshal's format is specific to the
+# Python version, so each version gets its own directory.
+COMPILED_RECIPE_DIRNAME = "compiled_recipes"
+# Cached parses that haven't been used for this many seconds, such as those of
+# earlier versions of a recipe, are removed
+COMPILED_RECIPE_MAX_AGE = 30 * 24 * 60 * 60
+
 
 class PreferenceError(Exception):
     """Preference exception"""
@@ -323,6 +347,40 @@ def get_all_prefs():
     return globalPreferences.get_all_prefs()
 
 
+# Identifies this run of autopkg, and is handed to the worker processes that
+# run recipes with --jobs, so that they can tell what they share with each other
+# from what was left by earlier runs
+_run_id = uuid.uuid4().hex
+
+
+def get_run_id() -> str:
+    """Return the id of the run this process is part of."""
+    return _run_id
+
+
+def set_run_id(run_id: str):
+    """Make this process part of the run with run_id."""
+    global _run_id
+    _run_id = run_id
+
+
+# Set while recipes of this run are processed concurrently, in worker
+# processes with --jobs or in threads with --check, so that what they share
+# is coordinated only when it needs to be
+_concurrent_run = False
+
+
+def is_concurrent_run() -> bool:
+    """Return True if recipes of this run may be processed concurrently."""
+    return _concurrent_run
+
+
+def set_concurrent_run(concurrent: bool):
+    """Note whether recipes of this run may be processed concurrently."""
+    global _concurrent_run
+    _concurrent_run = concurrent
+
+
 def remove_recipe_extension(name):
     """Removes supported recipe extensions from a filename or path.
     If the filename or path does not end with any known recipe extension,
@@ -333,6 +391,76 @@ def remove_recipe_extension(name):
     return name
 
 
+def compiled_recipe_path(data: bytes) -> str:
+    """Returns the path of the cached parse of the recipe file contents in
+    data"""
+    cache_dir = get_pref("CACHE_DIR") or "~/Library/AutoPkg/Cache"
+    return os.path.join(
+        os.path.expanduser(cache_dir),
+        COMPILED_RECIPE_DIRNAME,
+        f"py{sys.version_info.major}{sys.version_info.minor}",
+        hashlib.sha256(data).hexdigest() + ".marshal",
+    )
+
+
+_pruned_compiled_recipe_dirs = set()
+
+
+def prune_compiled_recipes(compiled_dir: str, max_age=COMPILED_RECIPE_MAX_AGE):
+    """Remove the cached parses in compiled_dir that haven't been used for
+    max_age seconds. Each use of a cached parse updates its mtime."""
+    cutoff = time.time() - max_age
+    try:
+        entries = list(os.scandir(compiled_dir))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.name.endswith(".marshal") and entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+        except OSError:
+            pass
+
+
+def yaml_recipe_from_file(filename):
+    """Parse a yaml recipe with the safe loader (libyaml's if available),
+    reusing a cached parse from an earlier run if the file hasn't changed."""
+    with open(filename, "rb") as f:
+        data = f.read()
+    cache_path = compiled_recipe_path(data)
+    try:
+        with open(cache_path, "rb") as f:
+            recipe_dict = marshal.load(f)
+    except (OSError, EOFError, TypeError, ValueError):
+        recipe_dict = None
+    if recipe_dict is not None:
+        # mark the parse as used, so that it isn't pruned
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+        return recipe_dict
+
+    # yaml is only imported once a yaml recipe needs to be parsed
+    import yaml
+
+    recipe_dict = yaml.load(data, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+    try:
+        # recipes with values marshal can't store, like dates, aren't cached
+        compiled = marshal.dumps(recipe_dict)
+        atomic_write(cache_path, lambda f: f.write(compiled))
+    except (OSError, ValueError):
+        pass
+    # a recipe that changed leaves its old parse behind, so once per run
+    # parses that are no longer used are cleared out
+    compiled_dir = os.path.dirname(cache_path)
+    if compiled_dir not in _pruned_compiled_recipe_dirs:
+        _pruned_compiled_recipe_dirs.add(compiled_dir)
+        prune_compiled_recipes(compiled_dir)
+    return recipe_dict
+
+
 def recipe_from_file(filename):
     """Create a recipe dictionary from a file. Handle exceptions and log"""
     if not os.path.isfile(filename):
@@ -341,9 +469,7 @@ def recipe_from_file(filename):
     if filename.endswith(".yaml"):
         try:
             # try to read it as yaml
-            with open(filename, "rb") as f:
-                recipe_dict = yaml.load(f, Loader=yaml.FullLoader)
-            return recipe_dict
+            return yaml_recipe_from_file(filename)
         except Exception as err:
             log_err(f"WARNING: yaml error for {filename}: {err}")
             return
@@ -380,30 +506,368 @@ def get_identifier_from_recipe_file(filename):
     return get_identifier(recipe_dict)
 
 
-def find_recipe_by_identifier(identifier, search_dirs):
-    """Search search_dirs for a recipe with the given
-    identifier"""
-    for directory in search_dirs:
-        # TODO: Combine with similar code in get_recipe_list() and find_recipe_by_name()
+def valid_recipe_dict_with_keys(recipe_dict, keys_to_verify):
+    """Attempts to read a dict and ensures the keys in
+    keys_to_verify exist. Returns False on any failure, True otherwise."""
+    if recipe_dict:
+        for key in keys_to_verify:
+            if key not in recipe_dict:
+                return False
+        # if we get here, we found all the keys
+        return True
+    return False
+
+
+def valid_recipe_dict(recipe_dict):
+    """Returns True if recipe dict is a valid recipe,
+    otherwise returns False"""
+    return (
+        valid_recipe_dict_with_keys(recipe_dict, ["Input", "Process"])
+        or valid_recipe_dict_with_keys(recipe_dict, ["Input", "Recipe"])
+        or valid_recipe_dict_with_keys(recipe_dict, ["Input", "ParentRecipe"])
+    )
+
+
+def valid_override_dict(recipe_dict):
+    """Returns True if the recipe is a valid override,
+    otherwise returns False"""
+    return valid_recipe_dict_with_keys(
+        recipe_dict, ["Input", "ParentRecipe"]
+    ) or valid_recipe_dict_with_keys(recipe_dict, ["Input", "Recipe"])
+
+
+def atomic_write(path, dump, binary=True, mode=None):
+    """Write the file at path by calling dump with a temporary file beside
+    it, then moving that over path, so that readers never see a partly
+    written file. mode sets the file's permissions, which otherwise are
+    0600. The temporary file is removed if anything fails, and the
+    exception is passed on."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb" if binary else "w") as f:
+            dump(f)
+        if mode is not None:
+            os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+class JSONCache:
+    """A dict of entries saved in a JSON file, usually in CACHE_DIR, so that
+    it carries over between runs. A saved file of another version than the
+    class's is ignored, so bump version when the format of entries
+    changes. Entries are only changed and saved while holding lock, so that
+    recipes checked in threads can share a cache."""
+
+    version = 1
+    description = "cache"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: VarDict = self._read()
+        self.changed = False
+        self.lock = threading.RLock()
+
+    def _read(self) -> VarDict:
+        """Read the saved entries, returning none if the file is missing,
+        unreadable or from an incompatible version."""
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get("version") != self.version:
+            return {}
+        return data.get("files", {})
+
+    def save(self):
+        """Atomically write the entries to disk if they have changed."""
+        with self.lock:
+            if not self.changed:
+                return
+            try:
+                atomic_write(
+                    self.path,
+                    lambda f: json.dump(
+                        {"version": self.version, "files": self.entries}, f
+                    ),
+                    binary=False,
+                )
+                self.changed = False
+            except (OSError, TypeError, ValueError) as err:
+                log_err(
+                    f"WARNING: Could not save {self.description} {self.path}: {err}"
+                )
+
+
+# Bump this when the format of recipe index entries changes
+RECIPE_INDEX_VERSION = 1
+RECIPE_INDEX_FILENAME = "recipe_index.json"
+# With SKIP_UNCHANGED set, the results of the steps after an unchanged download
+# are saved in this file in RECIPE_CACHE_DIR, to be replayed by later runs
+# with the same inputs instead of running those steps again
+LAST_RUN_FILENAME = "last_run.plist"
+# Outputs that report work a step did, which a replayed step didn't do again
+RUN_WORK_OUTPUTS = ("download_changed", "munki_repo_changed", "new_package_request")
+# With STEP_CACHE set, the results of cacheable processors are stored in this
+# subdirectory of CACHE_DIR
+STEP_CACHE_DIRNAME = "step_cache"
+
+
+class RecipeIndex(JSONCache):
+    """An index of the recipe files found in recipe search and override
+    directories.
+
+    Each indexed file records its identifier, parent recipe and whether it is a
+    valid recipe or override, along with its size and modification time. Entries
+    are grouped by the directory containing the file. A file
+    is only parsed again when its size or modification time changes. The index
+    is saved in CACHE_DIR so that it carries over between runs.
+
+    Directory listings are refreshed once per process; call invalidate() after
+    recipe directories are changed, e.g. by a git pull."""
+
+    version = RECIPE_INDEX_VERSION
+    description = "recipe index"
+
+    def __init__(self, index_path: Optional[str] = None):
+        if index_path is None:
+            cache_dir = get_pref("CACHE_DIR") or "~/Library/AutoPkg/Cache"
+            index_path = os.path.join(
+                os.path.expanduser(cache_dir), RECIPE_INDEX_FILENAME
+            )
+        super().__init__(index_path)
+        self.listings: Dict[Tuple[str, bool], List[Tuple[str, VarDict]]] = {}
+
+    def invalidate(self):
+        """Forget directory listings so they are refreshed on next use."""
+        self.listings = {}
+
+    def index_file(self, path: str) -> Optional[VarDict]:
+        """Return the index entry for a recipe file, (re-)parsing the file
+        only if it is not indexed or has changed."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        parent_dir, filename = os.path.split(path)
+        with self.lock:
+            entry = self.entries.get(parent_dir, {}).get(filename)
+        if (
+            entry
+            and entry["mtime_ns"] == stat.st_mtime_ns
+            and entry["size"] == stat.st_size
+        ):
+            return entry
+        recipe = recipe_from_file(path)
+        parent = None
+        if isinstance(recipe, dict):
+            parent = recipe.get("ParentRecipe")
+        entry = {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "identifier": get_identifier(recipe),
+            "parent": parent,
+            "valid_recipe": valid_recipe_dict(recipe),
+            "valid_override": valid_override_dict(recipe),
+        }
+        with self.lock:
+            self.entries.setdefault(parent_dir, {})[filename] = entry
+            self.changed = True
+        return entry
+
+    def listing(
+        self, directory: str, recurse: bool = True
+    ) -> List[Tuple[str, VarDict]]:
+        """Return a list of (path, entry) tuples for the recipe files in
+        directory (and, if recurse is True, one level down) in the same order
+        they were always matched by our recipe search rules."""
         normalized_dir = os.path.abspath(os.path.expanduser(directory))
+        key = (normalized_dir, recurse)
+        with self.lock:
+            if key not in self.listings:
+                self.listings[key] = self._list(normalized_dir, recurse)
+                self.save()
+            return self.listings[key]
+
+    def _list(self, normalized_dir: str, recurse: bool) -> List[Tuple[str, VarDict]]:
+        """Index the recipe files in normalized_dir for listing(), dropping
+        entries for files that are gone."""
         patterns = [os.path.join(normalized_dir, f"*{ext}") for ext in RECIPE_EXTS]
-        patterns.extend(
-            [os.path.join(normalized_dir, f"*/*{ext}") for ext in RECIPE_EXTS]
-        )
+        if recurse:
+            patterns.extend(
+                [os.path.join(normalized_dir, f"*/*{ext}") for ext in RECIPE_EXTS]
+            )
+        listing = []
+        seen = set()
         for pattern in patterns:
-            matches = glob.glob(pattern)
-            for match in matches:
-                if get_identifier_from_recipe_file(match) == identifier:
-                    return match
+            for match in glob.glob(pattern):
+                entry = self.index_file(match)
+                if entry:
+                    listing.append((match, entry))
+                    seen.add(match)
+
+        # drop entries for files that have been removed from this directory
+        for parent_dir in list(self.entries):
+            if parent_dir != normalized_dir and not (
+                recurse and os.path.dirname(parent_dir) == normalized_dir
+            ):
+                continue
+            dir_entries = self.entries[parent_dir]
+            for filename in list(dir_entries):
+                if os.path.join(parent_dir, filename) not in seen:
+                    del dir_entries[filename]
+                    self.changed = True
+            if not dir_entries:
+                del self.entries[parent_dir]
+        return listing
+
+    def find_by_identifier(self, identifier: str, search_dirs: List[str]):
+        """Return the path of the first recipe in search_dirs with the given
+        identifier, or None."""
+        for directory in search_dirs:
+            for path, entry in self.listing(directory):
+                if entry["identifier"] == identifier:
+                    return path
+        return None
 
-    return None
+    def find_by_name(self, name: str, search_dirs: List[str]):
+        """Return the path of the first valid recipe in search_dirs whose
+        filename is name plus a recipe extension, or None."""
+        filenames = {f"{name}{ext}" for ext in RECIPE_EXTS}
+        for directory in search_dirs:
+            for path, entry in self.listing(directory):
+                if os.path.basename(path) in filenames and entry["valid_recipe"]:
+                    return path
+        return None
+
+
+_recipe_index: Optional[RecipeIndex] = None
+
+
+def get_recipe_index() -> RecipeIndex:
+    """Return the shared RecipeIndex, creating it on first use so that it picks
+    up a CACHE_DIR given in a --prefs file."""
+    global _recipe_index
+    if _recipe_index is None:
+        _recipe_index = RecipeIndex()
+    return _recipe_index
+
+
+FILE_HASH_CACHE_VERSION = 1
+FILE_HASH_CACHE_FILENAME = "sha256_cache.json"
+# Files modified less than this many seconds before they were hashed are not
+# cached, since a later write within the same mtime tick would go unnoticed.
+FILE_HASH_CACHE_MIN_AGE = 2
+
+
+class FileHashCache(JSONCache):
+    """A persistent cache of SHA-256 hashes of files such as parent recipes and
+    non-core processors, used when generating and verifying trust info.
+
+    Each entry is keyed by the file's path and records its size, modification
+    time and inode. A file is only read and hashed again when one of those
+    changes. The cache is saved in CACHE_DIR so that it carries over between
+    runs."""
+
+    version = FILE_HASH_CACHE_VERSION
+    description = "hash cache"
+
+    def __init__(self, cache_path: Optional[str] = None):
+        if cache_path is None:
+            cache_dir = get_pref("CACHE_DIR") or "~/Library/AutoPkg/Cache"
+            cache_path = os.path.join(
+                os.path.expanduser(cache_dir), FILE_HASH_CACHE_FILENAME
+            )
+        super().__init__(cache_path)
+
+    def sha256(self, path: str) -> Optional[str]:
+        """Return the SHA-256 hex digest of the file at path, or None if it is
+        not a file. The file is only read if it isn't cached or has changed."""
+        path = os.path.abspath(path)
+        try:
+            before = os.stat(path)
+        except OSError:
+            before = None
+        if before is None or not os.path.isfile(path):
+            self._forget(path)
+            return None
+        with self.lock:
+            entry = self.entries.get(path)
+        if (
+            entry
+            and entry["size"] == before.st_size
+            and entry["mtime_ns"] == before.st_mtime_ns
+            and entry["inode"] == before.st_ino
+        ):
+            return entry["sha256"]
+
+        hashfunction = hashlib.sha256()
+        with open(path, "rb") as fileref:
+            while True:
+                chunk = fileref.read(2**16)
+                if not chunk:
+                    break
+                hashfunction.update(chunk)
+        digest = hashfunction.hexdigest()
+
+        # only cache the hash if the file was left alone while we read it and
+        # is old enough that another write couldn't share its mtime
+        after = os.stat(path)
+        if (before.st_size, before.st_mtime_ns, before.st_ino) == (
+            after.st_size,
+            after.st_mtime_ns,
+            after.st_ino,
+        ) and time.time() - after.st_mtime >= FILE_HASH_CACHE_MIN_AGE:
+            with self.lock:
+                self.entries[path] = {
+                    "size": after.st_size,
+                    "mtime_ns": after.st_mtime_ns,
+                    "inode": after.st_ino,
+                    "sha256": digest,
+                }
+                self.changed = True
+        else:
+            self._forget(path)
+        return digest
+
+    def _forget(self, path: str):
+        """Drop the cached hash of path, if any."""
+        with self.lock:
+            if self.entries.pop(path, None) is not None:
+                self.changed = True
+
+
+_file_hash_cache: Optional[FileHashCache] = None
+
+
+def get_file_hash_cache() -> FileHashCache:
+    """Return the shared FileHashCache, creating it on first use so that it
+    picks up a CACHE_DIR given in a --prefs file."""
+    global _file_hash_cache
+    if _file_hash_cache is None:
+        _file_hash_cache = FileHashCache()
+    return _file_hash_cache
+
+
+def find_recipe_by_identifier(identifier, search_dirs):
+    """Search search_dirs for a recipe with the given
+    identifier"""
+    return get_recipe_index().find_by_identifier(identifier, search_dirs)
 
 
 def get_autopkg_version():
     """Gets the version number of autopkg"""
     try:
-        version_plist = plistlib.load(
-            pkg_resources.resource_stream(__name__, "version.plist")
+        version_plist = plistlib.loads(
+            importlib.resources.files(__name__).joinpath("version.plist").read_bytes()
         )
     except Exception as ex:
         log_err(f"Unable to get autopkg version: {ex}")
@@ -420,19 +884,74 @@ def version_equal_or_greater(this, that):
     return LooseVersion(this) >= LooseVersion(that)
 
 
+# Strings compiled by compile_substitution(), keyed by the string itself
+_substitution_templates: Dict[str, Optional[tuple]] = {}
+SUBSTITUTION_TEMPLATE_CACHE_SIZE = 10000
+
+
+def compile_substitution(text):
+    """Split text into the literal text between %key% references and the
+    referenced keys, as a tuple of (literals, keys) with one more literal than
+    keys. Returns None if text contains no references. Results are cached, so
+    each distinct string is only scanned once."""
+    try:
+        return _substitution_templates[text]
+    except KeyError:
+        pass
+    literals = []
+    keys = []
+    position = 0
+    for match in RE_KEYREF.finditer(text):
+        literals.append(text[position : match.start()])
+        keys.append(match.group("key"))
+        position = match.end()
+    template = None
+    if keys:
+        literals.append(text[position:])
+        template = (tuple(literals), tuple(keys))
+    if len(_substitution_templates) >= SUBSTITUTION_TEMPLATE_CACHE_SIZE:
+        _substitution_templates.clear()
+    _substitution_templates[text] = template
+    return template
+
+
+def referenced_keys(item):
+    """Returns the set of keys referenced as %key% in item, which may be a
+    string or a list or dict containing strings."""
+    if isinstance(item, str):
+        template = compile_substitution(item)
+        return set(template[1]) if template else set()
+    keys = set()
+    if isinstance(item, (list, NSArray)):
+        for value in item:
+            keys.update(referenced_keys(value))
+    elif isinstance(item, (dict, NSDictionary)):
+        for value in item.values():
+            keys.update(referenced_keys(value))
+    return keys
+
+
 def update_data(a_dict, key, value):
     """Update a_dict keys with value. Existing data can be referenced
     by wrapping the key in %percent% signs."""
 
-    def getdata(match):
-        """Returns data from a match object"""
-        return a_dict[match.group("key")]
+    def substitute(item):
+        """Returns string item with its references replaced by data"""
+        template = compile_substitution(item)
+        if template is None:
+            return item
+        literals, keys = template
+        parts = [literals[0]]
+        for ref_key, literal in zip(keys, literals[1:]):
+            parts.append(a_dict[ref_key])
+            parts.append(literal)
+        return "".join(parts)
 
     def do_variable_substitution(item):
         """Do variable substitution for item"""
         if isinstance(item, str):
             try:
-                item = RE_KEYREF.sub(getdata, item)
+                item = substitute(item)
             except KeyError as err:
                 log_err(f"Use of undefined key in variable substitution: {err}")
         elif isinstance(item, (list, NSArray)):
@@ -453,6 +972,58 @@ def update_data(a_dict, key, value):
     a_dict[key] = do_variable_substitution(value)
 
 
+def update_all_data(a_dict):
+    """Do variable substitution for every value in a_dict. Values are
+    substituted after the values they reference, so references may be chained
+    in any order. Circular references are logged and the keys involved are
+    substituted in the order they were found."""
+    dependencies = {}
+    for key, value in a_dict.items():
+        if isinstance(value, str):
+            template = compile_substitution(value)
+            if template is None:
+                # nothing to substitute
+                continue
+            refs = set(template[1])
+        elif isinstance(value, (list, NSArray, dict, NSDictionary)):
+            refs = referenced_keys(value)
+        else:
+            continue
+        refs.discard(key)
+        dependencies[key] = sorted(ref for ref in refs if ref in a_dict)
+
+    order = []
+    # keys are absent while unvisited, False while being visited and True
+    # once the keys they reference have been ordered
+    visited = {}
+    for start in dependencies:
+        if start in visited:
+            continue
+        visited[start] = False
+        stack = [(start, iter(dependencies[start]))]
+        while stack:
+            key, remaining = stack[-1]
+            for ref in remaining:
+                if ref not in dependencies or visited.get(ref):
+                    continue
+                if ref not in visited:
+                    visited[ref] = False
+                    stack.append((ref, iter(dependencies[ref])))
+                    break
+                cycle = [item[0] for item in stack]
+                cycle = cycle[cycle.index(ref) :] + [ref]
+                log_err(
+                    "Circular reference in variable substitution: " + " -> ".join(cycle)
+                )
+            else:
+                stack.pop()
+                visited[key] = True
+                order.append(key)
+
+    for key in order:
+        update_data(a_dict, key, a_dict[key])
+
+
 def is_executable(exe_path):
     """Is exe_path executable?"""
     return os.path.exists(exe_path) and os.access(exe_path, os.X_OK)
@@ -539,6 +1110,13 @@ class Processor:
     returns a new or updated property list that can be processed further.
     """
 
+    # Processors whose results depend only on their input variables and the
+    # files those refer to set this, so that with STEP_CACHE set their results
+    # are reused while those are unchanged. Checks that depend on anything
+    # else, like code signature verification and the revocation and expiry of
+    # certificates, must not set it.
+    cacheable = False
+
     def __init__(self, env=None, infile=None, outfile=None):
         # super(Processor, self).__init__()
         self.env = env
@@ -560,6 +1138,11 @@ class Processor:
         """Stub method"""
         raise ProcessorError("Abstract method main() not implemented.")
 
+    def cache_paths(self):
+        """Return paths a cacheable processor reads or writes besides those in
+        its input and output variables, e.g. ones derived from defaults."""
+        return []
+
     def get_manifest(self):
         """Return Processor's description, input and output variables"""
         try:
@@ -680,9 +1263,247 @@ class Processor:
             fh.close()
 
 
+class LayeredEnv(MutableMapping):
+    """A processor environment layered on top of a base mapping, usually the
+    preferences, without copying it.
+
+    Reads fall through to the base, while writes and deletions only change
+    the environment's own layer. Values from the base that could be modified
+    in place, like dicts and lists, are copied into the environment's layer
+    the first time they are read, so changes to them never reach the base.
+    Everything else is shared with the base."""
+
+    IMMUTABLE_TYPES = (str, bytes, int, float, bool, type(None))
+
+    def __init__(self, base: VarDict, data: Optional[VarDict] = None):
+        self.base = base
+        self.data: VarDict = dict(data or {})
+        self.deleted = set()
+
+    def __getitem__(self, key):
+        try:
+            return self.data[key]
+        except KeyError:
+            if key in self.deleted:
+                raise
+        value = self.base[key]
+        if not isinstance(value, self.IMMUTABLE_TYPES):
+            value = self.data[key] = deepcopy(value)
+        return value
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.data.pop(key, None)
+        if key in self.base:
+            self.deleted.add(key)
+
+    def __contains__(self, key):
+        return key in self.data or (key in self.base and key not in self.deleted)
+
+    def __iter__(self):
+        for key in self.base:
+            if key in self.data or key not in self.deleted:
+                yield key
+        for key in self.data:
+            if key not in self.base:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.copy()!r})"
+
+    def copy(self) -> VarDict:
+        """Returns a shallow copy of the environment as a dict, without
+        copying any values from the base."""
+        merged = {key: self.base[key] for key in self.base if key not in self.deleted}
+        merged.update(self.data)
+        return merged
+
+    def changes(self) -> VarDict:
+        """Returns a dict of the keys set in the environment's own layer,
+        i.e. those that differ from the base or have been read from it."""
+        return dict(self.data)
+
+
 # AutoPackager class defintion
 
 
+class ResourceUsage:
+    """Measures what a piece of work costs, as a context manager. Afterwards
+    metrics holds its wall and CPU time in seconds, the CPU time of child
+    processes that finished meanwhile, how much the peak RSS grew, and the
+    bytes read from and written to storage, or where those aren't known, as
+    on macOS, the number of blocks. Measurements this platform can't make
+    are left out.
+
+    CPU time and, on Linux, I/O are counted for the current thread only, but
+    child process time, peak RSS and block counts are process-wide, so they
+    include any work done concurrently in other threads."""
+
+    def __init__(self):
+        self.metrics: VarDict = {}
+        self._start: VarDict = {}
+
+    @staticmethod
+    def _io_counters() -> VarDict:
+        for path in ("/proc/thread-self/io", "/proc/self/io"):
+            try:
+                with open(path) as f:
+                    fields = dict(line.split(": ") for line in f.read().splitlines())
+                return {
+                    "bytes_read": int(fields["read_bytes"]),
+                    "bytes_written": int(fields["write_bytes"]),
+                }
+            except (OSError, KeyError, ValueError):
+                continue
+        if resource is not None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            return {"blocks_read": usage.ru_inblock, "blocks_written": usage.ru_oublock}
+        return {}
+
+    def _snapshot(self) -> VarDict:
+        snapshot = {
+            "wall_time": time.perf_counter(),
+            "cpu_time": time.thread_time(),
+        }
+        if resource is not None:
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            snapshot["child_cpu_time"] = children.ru_utime + children.ru_stime
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # macOS reports bytes, Linux kilobytes
+            snapshot["peak_rss_growth"] = max_rss if is_mac() else max_rss * 1024
+        snapshot.update(self._io_counters())
+        return snapshot
+
+    def __enter__(self):
+        self._start = self._snapshot()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = self._snapshot()
+        for key, value in end.items():
+            if key in self._start:
+                delta = value - self._start[key]
+                if isinstance(delta, float):
+                    delta = round(delta, 6)
+                self.metrics[key] = delta
+        return False
+
+
+def path_fingerprint(path):
+    """Return a digest of the metadata of the file or directory tree at path.
+    A missing path, such as one inside a disk image or a glob pattern, is
+    represented by its nearest existing parent: a file's metadata, or the
+    names in a directory."""
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(dirs + files):
+                entry = os.path.join(root, name)
+                try:
+                    stat = os.lstat(entry)
+                except OSError:
+                    continue
+                relpath = os.path.relpath(entry, path)
+                digest.update(f"{relpath}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+        return digest.hexdigest()
+    parent = path
+    while not os.path.lexists(parent) and os.path.dirname(parent) != parent:
+        parent = os.path.dirname(parent)
+    if parent != path and os.path.isdir(parent):
+        digest.update("\n".join(sorted(os.listdir(parent))).encode())
+    elif os.path.lexists(parent):
+        stat = os.lstat(parent)
+        digest.update(
+            f"{parent}:{stat.st_size}:{stat.st_mtime_ns}:{stat.st_ino}".encode()
+        )
+    return digest.hexdigest()
+
+
+class StepCache:
+    """Results of cacheable processor steps, kept between runs.
+
+    Steps are keyed on their processor, its source and their input
+    variables. A stored result is reused while the files referred to by the
+    step's inputs and outputs are as the step left them, going by their
+    metadata rather than their contents."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def _paths(processor, values):
+        paths = set(processor.cache_paths())
+        for value in values:
+            for item in value if isinstance(value, list) else [value]:
+                if isinstance(item, str) and os.path.isabs(item):
+                    paths.add(item)
+        return sorted(paths)
+
+    def _path(self, processor, inputs):
+        module = sys.modules.get(type(processor).__module__)
+        source = getattr(module, "__file__", None)
+        key = json.dumps(
+            [
+                type(processor).__module__,
+                type(processor).__name__,
+                source and get_file_hash_cache().sha256(source),
+                get_autopkg_version(),
+                inputs,
+                processor.cache_paths(),
+            ],
+            sort_keys=True,
+            default=repr,
+        )
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.plist")
+
+    def get(self, processor, inputs) -> Optional[VarDict]:
+        """Return the stored result of running processor with inputs, as a
+        dict with the variables it set ("env") and removed ("removed"), or
+        None if there is no current one."""
+        try:
+            with open(self._path(processor, inputs), "rb") as f:
+                entry = plistlib.load(f)
+        except (OSError, ValueError, plistlib.InvalidFileException):
+            return None
+        for path, fingerprint in entry["paths"].items():
+            if path_fingerprint(path) != fingerprint:
+                return None
+        return entry
+
+    def put(self, processor, inputs, env_before):
+        """Store the result of running processor with inputs, given the
+        environment before it ran."""
+        changed = {
+            key: value
+            for key, value in processor.env.items()
+            if key not in env_before or env_before[key] != value
+        }
+        removed = [key for key in env_before if key not in processor.env]
+        paths = self._paths(processor, list(inputs.values()) + list(changed.values()))
+        entry = {
+            "paths": {path: path_fingerprint(path) for path in paths},
+            "env": changed,
+            "removed": removed,
+        }
+        try:
+            atomic_write(
+                self._path(processor, inputs), lambda f: plistlib.dump(entry, f)
+            )
+        except (OSError, TypeError, ValueError, OverflowError) as err:
+            # e.g. outputs that can't be stored in a plist
+            log_err(f"WARNING: Could not cache {type(processor).__name__}: {err}")
+
+
 class AutoPackagerError(Exception):
     """Error class"""
 
@@ -734,9 +1555,9 @@ class AutoPackager:
         inputs.update(recipe["Input"])
         inputs.update(cli_values)
         self.env.update(inputs)
-        # do any internal string substitutions
-        for key, value in list(self.env.items()):
-            update_data(self.env, key, value)
+        # do any internal string substitutions, substituting referenced
+        # values before the values that refer to them
+        update_all_data(self.env)
 
     def verify(self, recipe):
         """Verify a recipe and check for errors."""
@@ -788,6 +1609,113 @@ class AutoPackager:
             # Add output variables to set.
             variables.update(set(processor_class.output_variables.keys()))
 
+    def recipe_fingerprint(self, recipe):
+        """Return a hash object fed with everything a recipe run depends on
+        before its first step: the recipe chain, the processors it may load
+        from the chain's directories, and the recipe's input variables,
+        including those from the CLI and preferences."""
+        fingerprint = hashlib.sha256()
+        hash_cache = get_file_hash_cache()
+        chain = [recipe["RECIPE_PATH"]] + list(recipe.get("PARENT_RECIPES", []))
+        chain_dirs = sorted({os.path.dirname(path) for path in chain})
+        for step in recipe["Process"]:
+            name = extract_processor_name_with_recipe_identifier(step["Processor"])[0]
+            chain.extend(os.path.join(d, f"{name}.py") for d in chain_dirs)
+        for path in chain:
+            fingerprint.update(f"{path}:{hash_cache.sha256(path)}\n".encode())
+        fingerprint.update(
+            json.dumps(recipe["Process"], sort_keys=True, default=repr).encode()
+        )
+        self.update_fingerprint(fingerprint)
+        return fingerprint
+
+    def update_fingerprint(self, fingerprint):
+        """Feed the current environment to a fingerprint hash object.
+
+        Only values that can be stored as JSON are included, since the repr
+        of other objects can differ between runs. So are URLs, but without
+        their query strings, which for signed or expiring URLs change every
+        run; once a download is unchanged, its validators and hashes are what
+        tell whether the item they point at changed."""
+        values = {}
+        # a shallow copy, which for a LayeredEnv doesn't copy the preferences
+        for key, value in self.env.copy().items():
+            if isinstance(value, str) and value.startswith(("http://", "https://")):
+                value = urlsplit(value)._replace(query="", fragment="").geturl()
+            try:
+                values[key] = json.dumps(value, sort_keys=True)
+            except (TypeError, ValueError):
+                continue
+        fingerprint.update(json.dumps(values, sort_keys=True).encode())
+
+    def replay_last_run(self, last_run_path, fingerprint):
+        """If the last successful run had the same fingerprint at this point,
+        add the results and outputs of its remaining steps and return True."""
+        try:
+            with open(last_run_path, "rb") as f:
+                last_run = plistlib.load(f)
+        except (OSError, ValueError, plistlib.InvalidFileException):
+            return False
+        if last_run.get("fingerprint") != fingerprint:
+            return False
+        missing = [path for path in last_run["paths"] if not os.path.exists(path)]
+        if missing:
+            self.output(f"Not replaying last run, {missing[0]} is missing")
+            return False
+        self.output("Nothing changed since the last run, replaying its results")
+        # Older files may still have the work the last run did
+        self.env.update(self._without_run_work(last_run["env"]))
+        self.results.extend(
+            dict(item, Output=self._without_run_work(item["Output"]))
+            if "Output" in item
+            else item
+            for item in last_run["results"]
+        )
+        return True
+
+    @staticmethod
+    def _without_run_work(outputs):
+        """Return outputs without the summary results and flags that report
+        work a step did, such as a new download or import."""
+        return {
+            key: value
+            for key, value in outputs.items()
+            if not key.endswith("_summary_result") and key not in RUN_WORK_OUTPUTS
+        }
+
+    def save_last_run(self, last_run_path, fingerprint, results):
+        """Save the results and outputs of the steps after an unchanged
+        download, for replay_last_run() in later runs."""
+        outputs = {}
+        for item in results:
+            outputs.update(item.get("Output", {}))
+        outputs = self._without_run_work(outputs)
+        # What the steps cost and did this time says nothing about replaying
+        # them
+        results = [
+            {
+                key: self._without_run_work(value) if key == "Output" else value
+                for key, value in item.items()
+                if key != "Metrics"
+            }
+            for item in results
+        ]
+        paths = [
+            value
+            for value in outputs.values()
+            if isinstance(value, str) and os.path.isabs(value) and os.path.exists(value)
+        ]
+        last_run = {
+            "fingerprint": fingerprint,
+            "results": results,
+            "env": outputs,
+            "paths": paths,
+        }
+        try:
+            atomic_write(last_run_path, lambda f: plistlib.dump(last_run, f))
+        except (OSError, TypeError, ValueError, OverflowError) as err:
+            log_err(f"WARNING: Could not save {last_run_path}: {err}")
+
     def process(self, recipe):
         """Process a recipe."""
         identifier = self.get_recipe_identifier(recipe)
@@ -797,9 +1725,12 @@ class AutoPackager:
         )
         self.env["RECIPE_CACHE_DIR"] = os.path.join(cache_dir, identifier)
 
-        recipe_input_dict = {}
-        for key in list(self.env.keys()):
-            recipe_input_dict[key] = self.env[key]
+        # Only the recipe's own variables; preferences not overridden by the
+        # recipe or CLI are already in the preferences file
+        if isinstance(self.env, LayeredEnv):
+            recipe_input_dict = self.env.changes()
+        else:
+            recipe_input_dict = dict(self.env)
         self.results.append({"Recipe input": recipe_input_dict})
 
         # make sure the RECIPE_CACHE_DIR exists, creating it if needed
@@ -813,7 +1744,17 @@ class AutoPackager:
                 ) from err
 
         if self.verbose > 2:
-            pprint.pprint(self.env)
+            pprint.pprint(self.env.copy())
+
+        fingerprint = None
+        if self.env.get("SKIP_UNCHANGED"):
+            fingerprint = self.recipe_fingerprint(recipe)
+        last_run_path = os.path.join(self.env["RECIPE_CACHE_DIR"], LAST_RUN_FILENAME)
+        # The fingerprint and number of results at the first unchanged download
+        unchanged_at = None
+        step_cache = None
+        if self.env.get("STEP_CACHE"):
+            step_cache = StepCache(os.path.join(cache_dir, STEP_CACHE_DIRNAME))
 
         for step in recipe["Process"]:
 
@@ -836,8 +1777,25 @@ class AutoPackager:
                 # pretty print any defined input variables
                 pprint.pprint({"Input": input_dict})
 
+            cached = None
+            if step_cache and processor.cacheable:
+                cached = step_cache.get(processor, input_dict)
+                # shallow, so that preferences aren't copied into a LayeredEnv
+                env_before = self.env.copy()
             try:
-                self.env = processor.process()
+                with ResourceUsage() as usage:
+                    if cached:
+                        self.output(
+                            f"{step['Processor']}: inputs unchanged, reusing result",
+                            verbose_level=2,
+                        )
+                        self.env.update(cached["env"])
+                        for key in cached["removed"]:
+                            self.env.pop(key, None)
+                    else:
+                        self.env = processor.process()
+                        if step_cache and processor.cacheable:
+                            step_cache.put(processor, input_dict, env_before)
             except Exception as err:
                 if self.verbose > 2:
                     exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -872,15 +1830,36 @@ class AutoPackager:
                     "Processor": step["Processor"],
                     "Input": input_dict,
                     "Output": output_dict,
+                    "Metrics": usage.metrics,
                 }
             )
 
+            if (
+                fingerprint
+                and unchanged_at is None
+                and "download_changed" in processor.output_variables
+                and self.env.get("download_changed") is False
+            ):
+                # Nothing new was downloaded; if that was also the case last
+                # time, with the same inputs, the rest of the run would be
+                # the same as well
+                self.update_fingerprint(fingerprint)
+                unchanged_at = (fingerprint.hexdigest(), len(self.results))
+                if self.replay_last_run(last_run_path, unchanged_at[0]):
+                    return
+
             if self.env.get("stop_processing_recipe"):
                 # processing should stop now
                 break
 
+        if unchanged_at:
+            digest, count = unchanged_at
+            self.save_last_run(last_run_path, digest, self.results[count:])
+        elif fingerprint and os.path.exists(last_run_path):
+            os.unlink(last_run_path)
+
         if self.verbose > 2:
-            pprint.pprint(self.env)
+            pprint.pprint(self.env.copy())
 
 
 def _cmp(x, y):
@@ -956,30 +1935,99 @@ class APLooseVersion(LooseVersion):
 
 _CORE_PROCESSOR_NAMES = []
 _PROCESSOR_NAMES = []
+# Core processor names and the autopkglib submodules they are defined in. The
+# modules are only imported when a processor is first used.
+_CORE_PROCESSOR_MODULES: Dict[str, str] = {}
+_CORE_PROCESSOR_MANIFESTS: Dict[str, Optional[VarDict]] = {}
 
 
 def import_processors():
+    """Register the core processors found in this directory. The processors
+    themselves are imported lazily by load_processor()."""
     processor_files: List[str] = [
-        os.path.splitext(name)[0]
-        for name in pkg_resources.resource_listdir(__name__, "")
-        if name.endswith(".py")
+        os.path.splitext(entry.name)[0]
+        for entry in importlib.resources.files(__name__).iterdir()
+        if entry.name.endswith(".py")
     ]
 
-    # Warning! Fancy dynamic importing ahead!
-    #
-    # import the filename as a submodule
-    # then add the attribute with the same name to the globals()
-    #
-    # This is the equivalent of:
+    # Each module is expected to contain an attribute with the same name as
+    # the module, so that importing the processor is the equivalent of:
     #
     #    from Bar.Foo import Foo
     #
     for name in filter(lambda f: f not in ("__init__", "xattr"), processor_files):
-        globals()[name] = getattr(
-            __import__(__name__ + "." + name, fromlist=[name]), name
-        )
-        _PROCESSOR_NAMES.append(name)
-        _CORE_PROCESSOR_NAMES.append(name)
+        _CORE_PROCESSOR_MODULES[name] = __name__ + "." + name
+        if name not in _PROCESSOR_NAMES:
+            _PROCESSOR_NAMES.append(name)
+        if name not in _CORE_PROCESSOR_NAMES:
+            _CORE_PROCESSOR_NAMES.append(name)
+
+
+def load_processor(name):
+    """Imports a core processor and adds it to the autopkglib namespace.
+    Raises KeyError if there is no core processor with that name."""
+    module = importlib.import_module(_CORE_PROCESSOR_MODULES[name])
+    processor = getattr(module, name)
+    globals()[name] = processor
+    return processor
+
+
+def __getattr__(name):
+    """Imports core processors on first access, e.g. autopkglib.Copier"""
+    if name in _CORE_PROCESSOR_MODULES:
+        return load_processor(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def core_processor_manifest(name):
+    """Returns a dict with the description, input_variables and
+    output_variables of a core processor, read from its source code without
+    importing it. Returns None if they can't be determined that way, e.g. if
+    they are computed or inherited."""
+    if name not in _CORE_PROCESSOR_MANIFESTS:
+        _CORE_PROCESSOR_MANIFESTS[name] = _read_processor_manifest(name)
+    return _CORE_PROCESSOR_MANIFESTS[name]
+
+
+def _read_processor_manifest(name):
+    """Parses a core processor's source for core_processor_manifest()"""
+    if name not in _CORE_PROCESSOR_MODULES:
+        return None
+    try:
+        source = importlib.resources.files(__name__).joinpath(name + ".py").read_bytes()
+        tree = ast.parse(source)
+    except (OSError, SyntaxError, ValueError):
+        return None
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and node.name == name:
+            break
+    else:
+        return None
+    manifest = {}
+    for item in node.body:
+        if not (
+            isinstance(item, ast.Assign)
+            and len(item.targets) == 1
+            and isinstance(item.targets[0], ast.Name)
+        ):
+            continue
+        key = item.targets[0].id
+        if key not in ("description", "input_variables", "output_variables"):
+            continue
+        if (
+            key == "description"
+            and isinstance(item.value, ast.Name)
+            and item.value.id == "__doc__"
+        ):
+            manifest[key] = ast.get_docstring(node, clean=False)
+            continue
+        try:
+            manifest[key] = ast.literal_eval(item.value)
+        except (SyntaxError, TypeError, ValueError):
+            return None
+    if len(manifest) != 3:
+        return None
+    return manifest
 
 
 # convenience functions for adding and accessing processors
@@ -1008,9 +2056,23 @@ def extract_processor_name_with_recipe_identifier(processor_name):
     return (processor_name, identifier)
 
 
+# Serializes loading processors from recipe directories, as recipes may be
+# verified and run concurrently in threads
+_processor_load_lock = threading.Lock()
+
+
 def get_processor(processor_name, verbose=None, recipe=None, env=None):
     """Returns a Processor object given a name and optionally a recipe,
     importing a processor from the recipe directory if available"""
+    # Recipes checked in threads may import same-named processors from
+    # different repos, so one is loaded, registered and looked up at a time
+    with _processor_load_lock:
+        return _get_processor(processor_name, verbose, recipe, env)
+
+
+def _get_processor(processor_name, verbose, recipe, env):
+    """get_processor(), called with _processor_load_lock held"""
+    processor = None
     if env is None:
         env = {}
     if recipe:
@@ -1051,9 +2113,9 @@ def get_processor(processor_name, verbose=None, recipe=None, env=None):
                     # attempt to import the module
                     _tmp = imp.load_source(processor_name, processor_filename)
                     # look for an attribute with the step Processor name
-                    _processor = getattr(_tmp, processor_name)
+                    processor = getattr(_tmp, processor_name)
                     # add the processor to autopkglib's namespace
-                    add_processor(processor_name, _processor)
+                    add_processor(processor_name, processor)
                     # we've added a Processor, so stop searching
                     break
                 except (ImportError, AttributeError) as err:
@@ -1066,7 +2128,12 @@ def get_processor(processor_name, verbose=None, recipe=None, env=None):
                         traceback.print_tb(exc_traceback, limit=1, file=sys.stdout)
                     raise AutoPackagerLoadError(err) from err
 
-    return globals()[processor_name]
+    if processor is None:
+        processor = globals().get(processor_name)
+    if processor is None or isinstance(processor, types.ModuleType):
+        # not imported yet, or shadowed by its own submodule
+        processor = load_processor(processor_name)
+    return processor
 
 
 def processor_names():
@@ -1079,8 +2146,8 @@ def core_processor_names():
     return _CORE_PROCESSOR_NAMES
 
 
-# when importing autopkglib, need to also import all the processors
-# in this same directory
+# when importing autopkglib, register all the processors in this same
+# directory; they are imported on first use
 
 
 import_processors()
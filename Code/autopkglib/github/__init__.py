@@ -30,10 +30,21 @@ BASE_URL = "https://api.github.com"
 TOKEN_LOCATION = os.path.expanduser("~/.autopkg_gh_token")
 DEFAULT_SEARCH_USER = "autopkg"
 
+# X-RateLimit-Remaining of the last GitHub API response in this process
+_rate_limit_remaining: Optional[int] = None
+
+
+def get_rate_limit_remaining() -> Optional[int]:
+    """Return how many requests the GitHub API said were left in the current
+    rate limit window, or None if no API call has been made."""
+    return _rate_limit_remaining
+
 
 class GitHubSession(URLGetter):
     """Handles a session with the GitHub API"""
 
+    cache_responses = True
+
     def __init__(
         self, curl_path=None, curl_opts=None, github_url=None, token_path=TOKEN_LOCATION
     ):
@@ -270,6 +281,9 @@ To save the token, paste it to the following prompt."""
         header = self.parse_headers(raw_headers)
         if header["http_result_code"] != "000":
             self.http_result_code = int(header["http_result_code"])
+        if header.get("x-ratelimit-remaining", "").isdigit():
+            global _rate_limit_remaining
+            _rate_limit_remaining = int(header["x-ratelimit-remaining"])
 
         try:
             with open(temp_content) as f:
@@ -0,0 +1,1141 @@
+#!/usr/local/autopkg/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""In-process HTTP transport for URLGetter.
+
+URLGetter subclasses describe their requests as curl command lines. The
+transport here translates those command lines into requests served from a
+pool of keep-alive connections, producing the same output curl would. Command
+lines using options that have no clean equivalent are left to curl."""
+
+import base64
+import contextlib
+import email.utils
+import hashlib
+import http.client
+import json
+import marshal
+import os
+import socket
+import ssl
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
+from urllib.request import getproxies_environment, proxy_bypass_environment
+
+from autopkglib import atomic_write, get_pref, log_err
+
+# Maximum number of connections kept open to a single scheme/host/port
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 4
+# curl's default connect timeout, in seconds
+DEFAULT_CONNECT_TIMEOUT = 300
+# curl's default redirect limit with --location
+MAX_REDIRECTS = 50
+# Servers that sniff the User-Agent have only ever seen curl from AutoPkg, so
+# keep presenting as curl unless a recipe asks for something else.
+DEFAULT_USER_AGENT = "curl/8.7.1"
+CHUNK_SIZE = 64 * 1024
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+# Requests per second sent to a single host, 0 for no limit
+DEFAULT_RATE_LIMIT = 10
+# Responses asking us to slow down or try again later are retried this many
+# times, waiting as the server asks or backing off exponentially, unless
+# that would mean waiting more than DEFAULT_RETRY_MAX_WAIT seconds
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_MAX_WAIT = 60
+RETRY_CODES = (429, 500, 502, 503, 504)
+# A server error may come after a request has taken effect, so only requests
+# that can safely be repeated are retried on 5xx
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE")
+# Responses are cached in memory up to this many megabytes per run
+DEFAULT_RESPONSE_CACHE_SIZE_MB = 64
+# Persisted responses are stored in this subdirectory of CACHE_DIR
+RESPONSE_CACHE_DIRNAME = "http_cache"
+
+# Options that don't change what is sent or received
+_IGNORED_FLAGS = {"--silent", "-s", "--show-error", "-S", "--no-buffer", "-N"}
+_FLAGS = {
+    "--location": "follow_redirects",
+    "-L": "follow_redirects",
+    "--compressed": "compressed",
+    "--fail": "fail",
+    "-f": "fail",
+    "--head": "headers_only",
+    "-I": "headers_only",
+    "--include": "include",
+    "-i": "include",
+    "--insecure": "insecure",
+    "-k": "insecure",
+}
+_VALUE_OPTIONS = {
+    "--header": "header",
+    "-H": "header",
+    "--user-agent": "user_agent",
+    "-A": "user_agent",
+    "--referer": "referer",
+    "-e": "referer",
+    "--request": "method",
+    "-X": "method",
+    "--data": "data",
+    "-d": "data",
+    "--data-raw": "data_raw",
+    "--dump-header": "dump_header",
+    "-D": "dump_header",
+    "--output": "output",
+    "-o": "output",
+    "--url": "url",
+    "--max-time": "max_time",
+    "-m": "max_time",
+    "--connect-timeout": "connect_timeout",
+    "--speed-time": "speed_time",
+    "-y": "speed_time",
+    "--user": "user",
+    "-u": "user",
+    "--cookie": "cookie",
+    "-b": "cookie",
+    "--continue-at": "continue_at",
+    "-C": "continue_at",
+}
+
+
+class TransportError(Exception):
+    """A request failed. The message mimics curl's stderr for the same failure
+    so that callers can report and parse it as they always have. stdout
+    holds what curl would have printed before failing."""
+
+    def __init__(self, code, message):
+        self.code = code
+        self.stderr = f"curl: ({code}) {message}\n"
+        self.stdout = b""
+        super().__init__(self.stderr)
+
+
+class _Retry(Exception):
+    """Raised to retry a request after delay seconds."""
+
+    def __init__(self, host, delay):
+        self.host = host
+        self.delay = delay
+        super().__init__(host, delay)
+
+
+class Request:
+    """A single HTTP request, as described by a curl command line."""
+
+    def __init__(self):
+        self.url = None
+        self.method = None
+        self.headers: List[Tuple[str, str]] = []
+        self.removed_headers: List[str] = []
+        self.data: Optional[bytes] = None
+        self.output = None
+        self.dump_header = None
+        self.follow_redirects = False
+        self.compressed = False
+        self.fail = False
+        self.headers_only = False
+        self.include = False
+        self.insecure = False
+        self.connect_timeout = None
+        self.max_time = None
+        self.speed_time = None
+        # An offset to resume the output file from, or "-" for its size
+        self.continue_at = None
+        # An offset to write a partial (206) response at in an existing
+        # output file. curl has no equivalent; used for segmented downloads.
+        self.output_offset = None
+        # hashlib objects to update with the body as it is written
+        self.hashes = ()
+        # Set by the transport to the status of the final response and the
+        # number of body bytes received
+        self.status = None
+        self.size_downloaded = 0
+
+    def add_header(self, line):
+        """Add a header given as for curl's --header. Returns False for forms
+        the transport doesn't support."""
+        name, sep, value = line.partition(":")
+        if not sep:
+            if line.endswith(";") and line[:-1].strip():
+                # curl's syntax for sending a header with an empty value
+                self.headers.append((line[:-1].strip(), ""))
+                return True
+            return False
+        name = name.strip()
+        value = value.strip()
+        if not name or any(c.isspace() for c in name):
+            return False
+        if value:
+            self.headers.append((name, value))
+        else:
+            # An empty value removes a header curl would otherwise send
+            self.removed_headers.append(name.lower())
+        return True
+
+
+def parse_curl_cmd(curl_cmd) -> Optional[Request]:
+    """Translate a curl command line into a Request. Returns None if the
+    command uses anything the in-process transport can't reproduce, in which
+    case it should be run with curl."""
+    request = Request()
+    args = iter(curl_cmd[1:])
+    for arg in args:
+        if arg in _IGNORED_FLAGS:
+            continue
+        if arg in _FLAGS:
+            setattr(request, _FLAGS[arg], True)
+            continue
+        if arg in _VALUE_OPTIONS:
+            value = next(args, None)
+            if value is None or not _apply_option(request, _VALUE_OPTIONS[arg], value):
+                return None
+            continue
+        if arg.startswith("-") or request.url is not None:
+            return None
+        request.url = arg
+
+    if request.url is None:
+        return None
+    parts = urlsplit(request.url)
+    if parts.scheme.lower() not in ("http", "https") or not parts.hostname:
+        return None
+    if any(c.isspace() or ord(c) < 32 for c in request.url):
+        return None
+    proxies = getproxies_environment()
+    if parts.scheme.lower() in proxies and not proxy_bypass_environment(parts.hostname):
+        return None
+
+    if request.method is None:
+        if request.data is not None:
+            request.method = "POST"
+        elif request.headers_only:
+            request.method = "HEAD"
+        else:
+            request.method = "GET"
+    if request.data is not None and not _has_header(request, "Content-Type"):
+        request.headers.append(("Content-Type", "application/x-www-form-urlencoded"))
+    if parts.username is not None and not _has_header(request, "Authorization"):
+        request.headers.append(
+            ("Authorization", _basic_auth(parts.username, parts.password or ""))
+        )
+    return request
+
+
+def _apply_option(request, name, value) -> bool:
+    """Apply a curl option taking a value to request."""
+    if name == "header":
+        return request.add_header(value)
+    if name in ("user_agent", "referer"):
+        header = "User-Agent" if name == "user_agent" else "Referer"
+        request.headers.append((header, value))
+    elif name == "method":
+        request.method = value
+    elif name in ("data", "data_raw"):
+        if name == "data":
+            if value.startswith("@"):
+                return False
+            # curl strips newlines from --data arguments
+            value = value.replace("\r", "").replace("\n", "")
+        data = value.encode("utf-8")
+        request.data = data if request.data is None else request.data + b"&" + data
+    elif name in ("url", "output", "dump_header"):
+        if getattr(request, name) is not None:
+            return False
+        setattr(request, name, value)
+    elif name in ("max_time", "connect_timeout", "speed_time"):
+        try:
+            setattr(request, name, float(value))
+        except ValueError:
+            return False
+    elif name == "user":
+        user, sep, password = value.partition(":")
+        if not sep:
+            # curl would prompt for the password
+            return False
+        request.headers.append(("Authorization", _basic_auth(user, password)))
+    elif name == "continue_at":
+        if value != "-" and not value.isdigit():
+            return False
+        request.continue_at = value
+    elif name == "cookie":
+        if "=" not in value:
+            # A cookie jar file
+            return False
+        request.headers.append(("Cookie", value))
+    return True
+
+
+def _has_header(request, name):
+    """Return True if request has a header with name."""
+    return any(header.lower() == name.lower() for header, _ in request.headers)
+
+
+def _basic_auth(user, password):
+    """Return an Authorization header value for HTTP basic authentication."""
+    credentials = base64.b64encode(f"{user}:{password}".encode("utf-8"))
+    return "Basic " + credentials.decode("ascii")
+
+
+_tls_contexts: Dict[bool, ssl.SSLContext] = {}
+_tls_lock = threading.Lock()
+
+
+def tls_context(verify=True):
+    """Return the TLS context shared by all pooled connections."""
+    with _tls_lock:
+        if verify not in _tls_contexts:
+            # The system's trust store, which holds roots deployed by MDM or
+            # for TLS-inspecting proxies, plus certifi's bundle if installed
+            context = ssl.create_default_context()
+            try:
+                import certifi
+
+                context.load_verify_locations(cafile=certifi.where())
+            except (ImportError, OSError):
+                pass
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            _tls_contexts[verify] = context
+        return _tls_contexts[verify]
+
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections, at most max_per_host per scheme, host,
+    port and TLS verification setting."""
+
+    def __init__(self, max_per_host=DEFAULT_MAX_CONNECTIONS_PER_HOST):
+        self.max_per_host = max_per_host
+        self._lock = threading.Lock()
+        self._idle: Dict[tuple, List[http.client.HTTPConnection]] = {}
+        self._slots: Dict[tuple, threading.BoundedSemaphore] = {}
+
+    def _slot(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.max_per_host)
+            return self._slots[key]
+
+    def acquire(self, key, timeout):
+        """Return a tuple of a connection for key and whether it is being
+        reused. Blocks while max_per_host connections are in use."""
+        self._slot(key).acquire()
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port, verify = key
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(
+                host, port, timeout=timeout, context=tls_context(verify)
+            )
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        return conn, False
+
+    def release(self, key, conn, reusable=True):
+        """Return a connection to the pool, or close it if it can't be
+        reused."""
+        if reusable and conn.sock is not None:
+            with self._lock:
+                self._idle.setdefault(key, []).append(conn)
+        else:
+            conn.close()
+        self._slots[key].release()
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+
+class RateLimiter:
+    """Per-host token buckets shared by all requests in a process. Each host
+    is sent at most rate requests per second, in bursts of up to burst, and a
+    host that asks us to back off is paused for every request.
+
+    Worker processes started with --jobs each have their own, so together
+    they may send a host up to rate times the number of workers."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self._lock = threading.Lock()
+        # host -> (tokens, time.monotonic() they were counted at)
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._paused_until: Dict[str, float] = {}
+
+    def acquire(self, host):
+        """Wait until a request may be sent to host."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self._paused_until.get(host, 0) - now
+                if wait <= 0:
+                    if not self.rate:
+                        return
+                    tokens, counted = self._buckets.get(host, (self.burst, now))
+                    tokens = min(self.burst, tokens + (now - counted) * self.rate)
+                    if tokens >= 1:
+                        self._buckets[host] = (tokens - 1, now)
+                        return
+                    self._buckets[host] = (tokens, now)
+                    wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, host, seconds):
+        """Send no requests to host for the next seconds."""
+        with self._lock:
+            until = time.monotonic() + seconds
+            self._paused_until[host] = max(self._paused_until.get(host, 0), until)
+
+
+def numeric_pref(name, default, convert=float, minimum=0):
+    """Return the preference name converted with convert, or default if it
+    is unset. A value that can't be converted or is below minimum is
+    reported and replaced with default."""
+    value = get_pref(name)
+    if value is None:
+        return default
+    try:
+        value = convert(value)
+    except (TypeError, ValueError):
+        value = None
+    if value is None or value < minimum:
+        log_err(f"WARNING: Invalid {name}.")
+        return default
+    return value
+
+
+_rate_limiter: Optional[RateLimiter] = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Return this process's RateLimiter, created on first use from the
+    HTTP_RATE_LIMIT preference (requests per second per host, 0 for no
+    limit)."""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter(
+                numeric_pref("HTTP_RATE_LIMIT", DEFAULT_RATE_LIMIT)
+            )
+        return _rate_limiter
+
+
+_curl_slots: Dict[str, threading.BoundedSemaphore] = {}
+_curl_slots_lock = threading.Lock()
+
+
+def curl_slot(host):
+    """Return a context manager that waits until fewer curl processes than
+    the HTTP_MAX_CONNECTIONS_PER_HOST preference are running against host
+    in this process, as the pool transport limits its connections. A host
+    of None isn't limited."""
+    if host is None:
+        return contextlib.nullcontext()
+    with _curl_slots_lock:
+        if host not in _curl_slots:
+            _curl_slots[host] = threading.BoundedSemaphore(
+                numeric_pref(
+                    "HTTP_MAX_CONNECTIONS_PER_HOST",
+                    DEFAULT_MAX_CONNECTIONS_PER_HOST,
+                    int,
+                    minimum=1,
+                )
+            )
+        return _curl_slots[host]
+
+
+def retry_delay(response, attempt, method="GET") -> Optional[float]:
+    """Return how many seconds to wait before retrying response to a method
+    request, or None if it shouldn't be retried. Servers say how long with
+    Retry-After, GitHub with X-RateLimit-Reset when a rate limit is
+    exhausted; otherwise back off exponentially."""
+    if response.status == 403 and response.getheader("x-ratelimit-remaining") == "0":
+        try:
+            return max(float(response.getheader("x-ratelimit-reset")) - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+    if response.status not in RETRY_CODES:
+        return None
+    if response.status >= 500 and method not in IDEMPOTENT_METHODS:
+        return None
+    retry_after = (response.getheader("retry-after") or "").strip()
+    if retry_after.isdigit():
+        return float(retry_after)
+    if retry_after:
+        try:
+            when = email.utils.parsedate_to_datetime(retry_after)
+            return max(when.timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            pass
+    return float(2**attempt)
+
+
+class PooledTransport:
+    """Performs curl-described requests over pooled connections."""
+
+    name = "pool"
+
+    def __init__(self, max_per_host=None):
+        if max_per_host is None:
+            max_per_host = numeric_pref(
+                "HTTP_MAX_CONNECTIONS_PER_HOST",
+                DEFAULT_MAX_CONNECTIONS_PER_HOST,
+                int,
+                minimum=1,
+            )
+        self.pool = ConnectionPool(max_per_host)
+        self.limiter = get_rate_limiter()
+        self.retries = numeric_pref("HTTP_RETRIES", DEFAULT_RETRIES, int)
+        self.retry_max_wait = numeric_pref(
+            "HTTP_RETRY_MAX_WAIT", DEFAULT_RETRY_MAX_WAIT
+        )
+
+    def translate(self, curl_cmd) -> Optional[Request]:
+        """Return a Request for curl_cmd, or None to run it with curl."""
+        return parse_curl_cmd(curl_cmd)
+
+    def perform(self, request: Request) -> bytes:
+        """Perform request and return what curl would have written to stdout.
+        Raises TransportError on failure.
+
+        Responses asking us to slow down or try again later (429, 5xx and
+        GitHub's exhausted rate limits) are retried after the wait the
+        server asks for, during which no requests are sent to that host."""
+        deadline = time.monotonic() + request.max_time if request.max_time else None
+        attempt = 0
+        while True:
+            try:
+                return self._perform(request, attempt, deadline)
+            except _Retry as retry:
+                self.limiter.pause(retry.host, retry.delay)
+                attempt += 1
+
+    def _perform(self, request, attempt, deadline):
+        stdout = bytearray()
+        all_headers = bytearray()
+        header_file = None
+        try:
+            if request.dump_header not in (None, "-"):
+                header_file = open(request.dump_header, "wb")
+            url = request.url
+            method = request.method
+            headers = list(request.headers)
+            data = request.data
+            resume_from = self._resume_offset(request)
+            if resume_from:
+                headers.append(("Range", f"bytes={resume_from}-"))
+            for _ in range(MAX_REDIRECTS + 1):
+                response, key, conn = self._send(
+                    url, method, headers, data, request, deadline
+                )
+                raw_header = self._raw_header(response)
+                all_headers += raw_header
+                if request.dump_header == "-":
+                    stdout += raw_header
+                elif header_file:
+                    header_file.write(raw_header)
+                location = response.getheader("location")
+                if (
+                    request.follow_redirects
+                    and response.status in REDIRECT_CODES
+                    and location
+                ):
+                    self._discard_body(response, key, conn)
+                    next_url = urljoin(url, location)
+                    if urlsplit(next_url).scheme.lower() not in ("http", "https"):
+                        raise TransportError(1, f"Protocol not supported: {next_url}")
+                    if urlsplit(next_url).netloc != urlsplit(url).netloc:
+                        # Like curl, don't leak credentials to other hosts
+                        headers = [
+                            (name, value)
+                            for name, value in headers
+                            if name.lower() not in ("authorization", "cookie")
+                        ]
+                    if response.status == 303 or (
+                        response.status in (301, 302) and method == "POST"
+                    ):
+                        if method != "HEAD":
+                            method = "GET"
+                        data = None
+                        headers = [
+                            (name, value)
+                            for name, value in headers
+                            if name.lower() not in ("content-type", "content-length")
+                        ]
+                    url = next_url
+                    continue
+                break
+            else:
+                self.pool.release(key, conn, reusable=False)
+                raise TransportError(
+                    47, f"Maximum ({MAX_REDIRECTS}) redirects followed"
+                )
+
+            if attempt < self.retries:
+                delay = retry_delay(response, attempt, method)
+                if (
+                    delay is not None
+                    and delay <= self.retry_max_wait
+                    and (not deadline or delay < self._remaining(deadline))
+                ):
+                    self._discard_body(response, key, conn)
+                    raise _Retry(key[1], delay)
+
+            request.status = response.status
+            if request.fail and response.status >= 400:
+                self.pool.release(key, conn, reusable=False)
+                raise TransportError(
+                    22, f"The requested URL returned error: {response.status}"
+                )
+            if request.headers_only:
+                # With --head the headers are the output
+                self._discard_body(response, key, conn, read=False)
+                if request.output:
+                    with open(request.output, "wb") as f:
+                        f.write(all_headers)
+                else:
+                    stdout += all_headers
+                return bytes(stdout)
+            if request.output and response.status == 304:
+                self._discard_body(response, key, conn)
+                return bytes(stdout)
+            if resume_from and response.status == 416:
+                # Like curl, take this to mean the output is already complete
+                self._discard_body(response, key, conn)
+                return bytes(stdout)
+            if (resume_from or request.output_offset is not None) and (
+                response.status != 206
+            ):
+                self.pool.release(key, conn, reusable=False)
+                raise TransportError(
+                    33,
+                    "HTTP server doesn't seem to support byte ranges. Cannot resume.",
+                )
+            content_range = response.getheader("content-range") or ""
+            if request.output_offset is not None and not content_range.startswith(
+                f"bytes {request.output_offset}-"
+            ):
+                self.pool.release(key, conn, reusable=False)
+                raise TransportError(
+                    33, f"Unexpected Content-Range in response: {content_range}"
+                )
+            output_file = None
+            if request.output and request.output_offset is not None:
+                output_file = open(request.output, "r+b")
+                output_file.seek(request.output_offset)
+            elif request.output:
+                output_file = open(request.output, "ab" if resume_from else "wb")
+            sink = output_file.write if output_file else stdout.extend
+
+            def write(data):
+                sink(data)
+                request.size_downloaded += len(data)
+                for a_hash in request.hashes:
+                    a_hash.update(data)
+
+            try:
+                if request.include:
+                    sink(bytes(all_headers))
+                self._read_body(
+                    response, key, conn, write, request.compressed, deadline
+                )
+            finally:
+                if output_file:
+                    output_file.close()
+            return bytes(stdout)
+        except TransportError as err:
+            err.stdout = bytes(stdout)
+            raise
+        except OSError as err:
+            raise TransportError(23, f"Failure writing output: {err}") from err
+        finally:
+            if header_file:
+                header_file.close()
+
+    @staticmethod
+    def _resume_offset(request):
+        """Return the byte offset to resume the output file from, or 0."""
+        if request.continue_at is None:
+            return 0
+        if request.continue_at != "-":
+            return int(request.continue_at)
+        try:
+            return os.path.getsize(request.output)
+        except (OSError, TypeError):
+            return 0
+
+    def _send(self, url, method, headers, data, request, deadline):
+        """Send a request and return the response with its connection."""
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port, not request.insecure)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        default_headers = [
+            ("User-Agent", DEFAULT_USER_AGENT),
+            ("Accept", "*/*"),
+        ]
+        if request.compressed:
+            default_headers.append(("Accept-Encoding", "gzip, deflate"))
+        custom = {name.lower() for name, _ in headers}
+        send_headers = [
+            (name, value)
+            for name, value in default_headers
+            if name.lower() not in custom
+            and name.lower() not in request.removed_headers
+        ] + headers
+        if data is not None:
+            send_headers.append(("Content-Length", str(len(data))))
+
+        self.limiter.acquire(parts.hostname)
+        connect_timeout = request.connect_timeout or DEFAULT_CONNECT_TIMEOUT
+        if deadline:
+            connect_timeout = min(connect_timeout, self._remaining(deadline))
+        while True:
+            conn, reused = self.pool.acquire(key, connect_timeout)
+            try:
+                if conn.sock is None:
+                    conn.timeout = connect_timeout
+                    conn.connect()
+                read_timeout = request.speed_time
+                if deadline:
+                    read_timeout = min(
+                        read_timeout or float("inf"), self._remaining(deadline)
+                    )
+                conn.sock.settimeout(read_timeout)
+                conn.putrequest(
+                    method,
+                    path,
+                    skip_host="host" in custom,
+                    skip_accept_encoding=True,
+                )
+                for name, value in send_headers:
+                    conn.putheader(name, value)
+                conn.endheaders(data)
+                response = conn.getresponse()
+                return response, key, conn
+            except (
+                http.client.RemoteDisconnected,
+                ConnectionResetError,
+                BrokenPipeError,
+            ) as err:
+                self.pool.release(key, conn, reusable=False)
+                if reused:
+                    # The server closed an idle connection; try a new one
+                    continue
+                raise TransportError(56, f"Failure when receiving data: {err}")
+            except Exception as err:
+                self.pool.release(key, conn, reusable=False)
+                raise self._transport_error(err, parts.hostname) from err
+
+    def _read_body(self, response, key, conn, write, compressed, deadline):
+        """Read the response body, decoding it if it was compressed at our
+        request, and pass it to write."""
+        decoder = None
+        encoding = (response.getheader("content-encoding") or "").strip().lower()
+        if compressed and encoding in ("gzip", "x-gzip", "deflate"):
+            decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+            if encoding == "deflate":
+                decoder = _DeflateDecoder()
+        try:
+            while True:
+                if deadline and self._remaining(deadline) <= 0:
+                    raise socket.timeout("timed out")
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    if response.length:
+                        # The server closed the connection early
+                        raise http.client.IncompleteRead(b"", response.length)
+                    break
+                write(decoder.decompress(chunk) if decoder else chunk)
+            if decoder:
+                write(decoder.flush())
+        except zlib.error as err:
+            self.pool.release(key, conn, reusable=False)
+            raise TransportError(61, f"Error while processing content: {err}")
+        except TransportError:
+            self.pool.release(key, conn, reusable=False)
+            raise
+        except OSError as err:
+            self.pool.release(key, conn, reusable=False)
+            if isinstance(err, (socket.timeout, ConnectionError)):
+                raise self._transport_error(err, key[1]) from err
+            raise TransportError(23, f"Failure writing output: {err}") from err
+        except http.client.HTTPException as err:
+            self.pool.release(key, conn, reusable=False)
+            raise self._transport_error(err, key[1]) from err
+        self.pool.release(key, conn, reusable=not response.will_close)
+
+    def _discard_body(self, response, key, conn, read=True):
+        """Finish with a response whose body isn't wanted. Small bodies are
+        drained so the connection can be reused."""
+        if read and response.length is not None and response.length <= CHUNK_SIZE:
+            try:
+                response.read()
+            except (OSError, http.client.HTTPException):
+                self.pool.release(key, conn, reusable=False)
+                return
+            self.pool.release(key, conn, reusable=not response.will_close)
+            return
+        self.pool.release(key, conn, reusable=False)
+
+    @staticmethod
+    def _raw_header(response) -> bytes:
+        """Return the status line and headers of response as curl dumps
+        them."""
+        version = "1.0" if response.version == 10 else "1.1"
+        lines = [f"HTTP/{version} {response.status} {response.reason}"]
+        lines.extend(f"{name}: {value}" for name, value in response.getheaders())
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1", "replace")
+
+    @staticmethod
+    def _remaining(deadline):
+        return max(deadline - time.monotonic(), 0.001)
+
+    @staticmethod
+    def _transport_error(err, host):
+        """Return a TransportError with the curl exit code matching err."""
+        if isinstance(err, TransportError):
+            return err
+        if isinstance(err, socket.gaierror):
+            return TransportError(6, f"Could not resolve host: {host}")
+        if isinstance(err, (socket.timeout, TimeoutError)):
+            return TransportError(28, f"Operation timed out: {err}")
+        if isinstance(err, ssl.SSLCertVerificationError):
+            return TransportError(60, f"SSL certificate problem: {err.verify_message}")
+        if isinstance(err, ssl.SSLError):
+            return TransportError(35, f"SSL connect error: {err}")
+        if isinstance(err, ConnectionRefusedError):
+            return TransportError(7, f"Failed to connect to {host}: {err}")
+        if isinstance(err, http.client.IncompleteRead):
+            return TransportError(
+                18,
+                f"transfer closed with {err.expected} bytes remaining to read",
+            )
+        if isinstance(err, http.client.HTTPException):
+            return TransportError(8, f"Weird server reply: {err!r}")
+        return TransportError(7, f"Failed to connect to {host}: {err}")
+
+
+class ResponseCache:
+    """Responses to GET and HEAD requests, shared by all processors in a run
+    that opt in with URLGetter.cache_responses.
+
+    Entries are keyed on the method, URL, request headers and the options that
+    shape the output, and hold what curl would have written to stdout and to
+    its --output file. Only complete 200 responses are cached. The least
+    recently used entries are evicted once the cache holds more than max_bytes.
+    If ttl is set, entries are also saved in cache_dir and reused by later
+    runs for ttl seconds; responses to requests carrying credentials are never
+    saved. Saved entries that have expired, and the oldest ones beyond
+    max_bytes, are removed the first time a run saves one."""
+
+    def __init__(self, max_bytes, ttl=0, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.cache_dir = cache_dir if ttl else None
+        self.size = 0
+        # Lookups answered from the cache and not, counted per thread so a
+        # recipe can tell its own apart from those of recipes run alongside
+        self._lookups = threading.local()
+        self._entries: "OrderedDict[str, Tuple[bytes, Optional[bytes]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._collected = False
+
+    def _count_lookup(self, hit):
+        """Count a lookup by the calling thread for lookups()"""
+        hits, misses = self.lookups()
+        self._lookups.counts = (hits + 1, misses) if hit else (hits, misses + 1)
+
+    def lookups(self) -> Tuple[int, int]:
+        """Return the number of lookups made by the calling thread that were
+        answered from the cache and that were not."""
+        return getattr(self._lookups, "counts", (0, 0))
+
+    @staticmethod
+    def key(request) -> Optional[str]:
+        """Return the cache key for request, or None if it can't be cached."""
+        if request.method not in ("GET", "HEAD"):
+            return None
+        if request.dump_header not in (None, "-"):
+            return None
+        headers = sorted((name.lower(), value) for name, value in request.headers)
+        shape = [
+            request.method,
+            request.url,
+            headers,
+            sorted(request.removed_headers),
+            request.dump_header,
+            request.output is not None,
+            request.follow_redirects,
+            request.compressed,
+            request.fail,
+            request.headers_only,
+            request.include,
+            request.insecure,
+            request.continue_at,
+        ]
+        return hashlib.sha256(json.dumps(shape).encode("utf-8")).hexdigest()
+
+    def get(self, request) -> Optional[bytes]:
+        """Return the cached stdout for request, writing the cached body to
+        its --output file, or None if it isn't cached."""
+        key = self.key(request)
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None:
+            entry = self._load(key)
+            if entry is None:
+                self._count_lookup(hit=False)
+                return None
+            self._store(key, entry)
+        self._count_lookup(hit=True)
+        stdout, body = entry
+        if request.output is not None:
+            with open(request.output, "wb") as f:
+                f.write(body or b"")
+        request.status = 200
+        return stdout
+
+    def put(self, request, stdout):
+        """Cache the response to a request that was just performed."""
+        key = self.key(request)
+        if key is None or request.status != 200:
+            return
+        body = None
+        if request.output is not None:
+            try:
+                if os.path.getsize(request.output) > self.max_bytes:
+                    return
+                with open(request.output, "rb") as f:
+                    body = f.read()
+            except OSError:
+                return
+        entry = (stdout, body)
+        if self._store(key, entry) and self.cache_dir and not _has_credentials(request):
+            self._save(key, entry)
+
+    def _store(self, key, entry) -> bool:
+        """Add entry to the in-memory cache, evicting as needed. Returns False
+        if the entry is too large to cache."""
+        size = len(entry[0]) + len(entry[1] or b"")
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0]) + len(old[1] or b"")
+            self._entries[key] = entry
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (stdout, body) = self._entries.popitem(last=False)
+                self.size -= len(stdout) + len(body or b"")
+        return True
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".marshal")
+
+    def _load(self, key):
+        """Return a saved entry that hasn't expired, or None."""
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                stored_at, stdout, body = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if time.time() - stored_at > self.ttl:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return None
+        return stdout, body
+
+    def _save(self, key, entry):
+        """Atomically save an entry for later runs."""
+        with self._lock:
+            collect, self._collected = not self._collected, True
+        if collect:
+            self.collect_garbage()
+        try:
+            atomic_write(
+                self._path(key),
+                lambda f: marshal.dump((time.time(), entry[0], entry[1]), f),
+            )
+        except OSError as err:
+            log_err(f"WARNING: Could not save HTTP response cache entry: {err}")
+
+    def collect_garbage(self):
+        """Remove saved entries that have expired, then the oldest ones until
+        those left take up no more than max_bytes."""
+        try:
+            entries = list(os.scandir(self.cache_dir))
+        except OSError:
+            return
+        now = time.time()
+        kept = []
+        for entry in entries:
+            if not entry.name.endswith(".marshal"):
+                continue
+            try:
+                stat = entry.stat()
+                # entries are written once, so their mtime is when they were
+                # stored
+                if now - stat.st_mtime > self.ttl:
+                    os.unlink(entry.path)
+                else:
+                    kept.append((stat.st_mtime, stat.st_size, entry.path))
+            except OSError:
+                pass
+        total = sum(size for _, size, _ in kept)
+        for _, size, path in sorted(kept):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Forget all responses cached in memory."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+def _has_credentials(request):
+    """Return True if request carries credentials or cookies."""
+    return _has_header(request, "Authorization") or _has_header(request, "Cookie")
+
+
+_response_cache: Optional[ResponseCache] = None
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Return the shared ResponseCache, or None if it is disabled. It is
+    created on first use from the HTTP_CACHE_SIZE_MB (0 disables the cache)
+    and HTTP_CACHE_TTL (seconds to keep responses between runs, 0 to keep
+    them only for this run) preferences."""
+    global _response_cache
+    if _response_cache is None:
+        size_mb = get_pref("HTTP_CACHE_SIZE_MB")
+        if size_mb is None:
+            size_mb = DEFAULT_RESPONSE_CACHE_SIZE_MB
+        ttl = get_pref("HTTP_CACHE_TTL") or 0
+        try:
+            size_mb, ttl = float(size_mb), float(ttl)
+        except (TypeError, ValueError):
+            log_err("WARNING: Invalid HTTP_CACHE_SIZE_MB or HTTP_CACHE_TTL.")
+            size_mb, ttl = DEFAULT_RESPONSE_CACHE_SIZE_MB, 0
+        cache_dir = os.path.join(
+            os.path.expanduser(get_pref("CACHE_DIR") or "~/Library/AutoPkg/Cache"),
+            RESPONSE_CACHE_DIRNAME,
+        )
+        _response_cache = ResponseCache(int(size_mb * 1024 * 1024), ttl, cache_dir)
+    if not _response_cache.max_bytes:
+        return None
+    return _response_cache
+
+
+class _DeflateDecoder:
+    """Decodes Content-Encoding: deflate, which servers send both with and
+    without the zlib wrapper."""
+
+    def __init__(self):
+        self._decoder = zlib.decompressobj()
+        self._first = True
+
+    def decompress(self, data):
+        if self._first:
+            self._first = False
+            try:
+                return self._decoder.decompress(data)
+            except zlib.error:
+                self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decoder.decompress(data)
+
+    def flush(self):
+        return self._decoder.flush()
+
+
+TRANSPORTS = {PooledTransport.name: PooledTransport}
+_transports: Dict[str, object] = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(name):
+    """Return the shared transport instance registered under name, or None if
+    there is no such transport."""
+    with _transports_lock:
+        if name not in _transports:
+            if name not in TRANSPORTS:
+                return None
+            _transports[name] = TRANSPORTS[name]()
+        return _transports[name]
+
+
+def register_transport(name, factory):
+    """Make a transport available to URLGetter under name. factory is called
+    with no arguments and must return an object with translate() and
+    perform() methods like PooledTransport's."""
+    with _transports_lock:
+        TRANSPORTS[name] = factory
+        _transports.pop(name, None)
+
+
+def close_transports():
+    """Close the idle connections of all transports created so far."""
+    with _transports_lock:
+        for transport in _transports.values():
+            pool = getattr(transport, "pool", None)
+            if pool is not None:
+                pool.close()
+
+
+__all__ = [
+    "ConnectionPool",
+    "PooledTransport",
+    "RateLimiter",
+    "Request",
+    "ResponseCache",
+    "TransportError",
+    "curl_slot",
+    "get_rate_limiter",
+    "get_response_cache",
+    "get_transport",
+    "numeric_pref",
+    "parse_curl_cmd",
+    "register_transport",
+    "retry_delay",
+    "tls_context",
+]
@@ -2,8 +2,13 @@
 
 import imp
 import json
+import multiprocessing
 import os
 import plistlib
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 from textwrap import dedent
 from unittest.mock import mock_open, patch
@@ -253,6 +258,813 @@ class TestAutoPkg(unittest.TestCase):
         id = autopkglib.get_identifier_from_recipe_file("fake")
         self.assertIsNone(id)
 
+    def test_core_processor_manifest_matches_processor(self):
+        """core_processor_manifest should describe a processor the same way
+        the imported processor does."""
+        manifest = autopkglib.core_processor_manifest("FileCreator")
+        processor = autopkglib.get_processor("FileCreator")
+        self.assertEqual(manifest["description"], processor.description)
+        self.assertEqual(manifest["input_variables"], processor.input_variables)
+        self.assertEqual(manifest["output_variables"], processor.output_variables)
+        self.assertIsNone(autopkglib.core_processor_manifest("NotAProcessor"))
+
+    def test_get_processor_imports_core_processors_lazily(self):
+        """get_processor should return the processor class even if only its
+        module has been imported so far."""
+        from autopkglib.Copier import Copier
+
+        self.assertIn("Copier", autopkglib.core_processor_names())
+        self.assertIs(autopkglib.get_processor("Copier"), Copier)
+        self.assertIs(autopkglib.Copier, Copier)
+        with self.assertRaises(KeyError):
+            autopkglib.get_processor("NotAProcessor")
+
+    def test_get_processor_keeps_same_named_processors_apart(self):
+        """get_processor should return the processor from the recipe's own
+        repo when several repos have one with the same name."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            recipes = []
+            for repo in ("first", "second"):
+                os.makedirs(os.path.join(tmp_dir, repo))
+                with open(os.path.join(tmp_dir, repo, "SameName.py"), "w") as f:
+                    f.write(
+                        "from autopkglib import Processor\n"
+                        f"class SameName(Processor):\n    repo = {repo!r}\n"
+                    )
+                recipe_path = os.path.join(tmp_dir, repo, "Test.recipe")
+                recipes.append({"RECIPE_PATH": recipe_path})
+            for repo, recipe in zip(("first", "second"), recipes):
+                processor = autopkglib.get_processor("SameName", recipe=recipe)
+                self.assertEqual(processor.repo, repo)
+
+    def test_autopkg_startup_defers_optional_imports(self):
+        """Loading the autopkg tool should not import processors, yaml, difflib
+        or the GitHub code before a verb needs them."""
+        code_dir = os.path.join(os.path.dirname(__file__), "..")
+        script = (
+            "import imp, sys; imp.load_source('autopkg', sys.argv[1]); "
+            "print('\\n'.join(sys.modules))"
+        )
+        proc = subprocess.run(
+            [sys.executable, "-c", script, os.path.join(code_dir, "autopkg")],
+            capture_output=True,
+            cwd=code_dir,
+            env=dict(os.environ, PYTHONPATH=os.path.abspath(code_dir)),
+            text=True,
+        )
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        modules = set(proc.stdout.split())
+        for module in ("yaml", "difflib", "autopkglib.github", "autopkglib.Copier"):
+            self.assertNotIn(module, modules)
+
+    def test_update_data_substitutes_references(self):
+        """update_data should substitute %key% references in nested values."""
+        env = {"NAME": "Firefox", "VERSION": "1.0"}
+        autopkglib.update_data(
+            env,
+            "pkginfo",
+            {"name": "%NAME%", "files": ["%NAME%-%VERSION%.dmg", "%%NAME%%"]},
+        )
+        self.assertEqual(
+            env["pkginfo"],
+            {"name": "Firefox", "files": ["Firefox-1.0.dmg", "%Firefox%"]},
+        )
+
+    @patch("autopkglib.log_err")
+    def test_update_all_data_resolves_chained_references(self, mock_log_err):
+        """update_all_data should substitute values after the values they
+        reference, and report circular references."""
+        env = {
+            "URL": "%BASE_URL%/%NAME%.dmg",
+            "BASE_URL": "https://%HOST%",
+            "HOST": "example.com",
+            "NAME": "Firefox",
+            "PATH": "%PATH%:/usr/local/bin",
+            "FIRST": "%SECOND%",
+            "SECOND": "%FIRST%",
+        }
+        autopkglib.update_all_data(env)
+        self.assertEqual(env["URL"], "https://example.com/Firefox.dmg")
+        self.assertEqual(env["PATH"], "%PATH%:/usr/local/bin:/usr/local/bin")
+        mock_log_err.assert_called_once_with(
+            "Circular reference in variable substitution: FIRST -> SECOND -> FIRST"
+        )
+
+    def test_layered_env_does_not_modify_base(self):
+        """LayeredEnv should read through to its base without ever changing
+        it, even when mutable values are changed in place."""
+        base = {"CACHE_DIR": "/cache", "RECIPE_REPOS": {"repo": {"URL": "url"}}}
+        env = autopkglib.LayeredEnv(base)
+        env["NAME"] = "Firefox"
+        env["RECIPE_REPOS"]["other"] = {"URL": "other"}
+        del env["CACHE_DIR"]
+        self.assertEqual(
+            base, {"CACHE_DIR": "/cache", "RECIPE_REPOS": {"repo": {"URL": "url"}}}
+        )
+        self.assertNotIn("CACHE_DIR", env)
+        self.assertEqual(list(env), ["RECIPE_REPOS", "NAME"])
+        self.assertEqual(len(env["RECIPE_REPOS"]), 2)
+        env["CACHE_DIR"] = "/other"
+        self.assertEqual(
+            env.copy(),
+            {
+                "CACHE_DIR": "/other",
+                "RECIPE_REPOS": env["RECIPE_REPOS"],
+                "NAME": "Firefox",
+            },
+        )
+        autopkglib.update_data(env, "PATH", "%CACHE_DIR%/%NAME%")
+        self.assertEqual(env["PATH"], "/other/Firefox")
+
+    def test_recipe_input_leaves_out_preferences(self):
+        """The recipe input recorded in the receipt shouldn't include
+        preferences the recipe run didn't change."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            env = autopkglib.LayeredEnv(
+                {"CACHE_DIR": tmp_dir, "GITHUB_TOKEN": "secret"}, {"NAME": "Test"}
+            )
+            autopackager = autopkglib.AutoPackager(
+                type("Options", (), {"verbose": 0}), env
+            )
+            autopackager.process(
+                {"Identifier": "com.example.input", "Input": {}, "Process": []}
+            )
+        recipe_input = autopackager.results[0]["Recipe input"]
+        self.assertEqual(recipe_input["NAME"], "Test")
+        self.assertIn("RECIPE_CACHE_DIR", recipe_input)
+        self.assertNotIn("GITHUB_TOKEN", recipe_input)
+
+    def _write_recipe(self, directory, filename, recipe):
+        """Write a recipe plist to directory and return its path."""
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, filename)
+        with open(path, "wb") as f:
+            plistlib.dump(recipe, f)
+        return path
+
+    def test_recipe_index_finds_recipes(self):
+        """RecipeIndex should find recipes by identifier and by name."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            recipes_dir = os.path.join(tmp_dir, "recipes")
+            download_path = self._write_recipe(
+                recipes_dir, "GoogleChrome.download.recipe", self.download_struct
+            )
+            munki_path = self._write_recipe(
+                os.path.join(recipes_dir, "GoogleChrome"),
+                "GoogleChrome.munki.recipe",
+                self.munki_struct,
+            )
+            index = autopkglib.RecipeIndex(os.path.join(tmp_dir, "index.json"))
+            self.assertEqual(
+                index.find_by_identifier(
+                    "com.github.autopkg.munki.google-chrome", [recipes_dir]
+                ),
+                munki_path,
+            )
+            self.assertEqual(
+                index.find_by_name("GoogleChrome.download", [recipes_dir]),
+                download_path,
+            )
+            self.assertIsNone(
+                index.find_by_identifier("com.example.nope", [recipes_dir])
+            )
+
+    def test_recipe_index_only_parses_changed_files(self):
+        """RecipeIndex should reuse saved entries for unchanged files."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            recipes_dir = os.path.join(tmp_dir, "recipes")
+            index_path = os.path.join(tmp_dir, "index.json")
+            self._write_recipe(
+                recipes_dir, "GoogleChrome.download.recipe", self.download_struct
+            )
+            munki_path = self._write_recipe(
+                recipes_dir, "GoogleChrome.munki.recipe", self.munki_struct
+            )
+            autopkglib.RecipeIndex(index_path).listing(recipes_dir)
+            self.assertTrue(os.path.exists(index_path))
+
+            changed = dict(self.munki_struct, Identifier="com.example.changed")
+            with open(munki_path, "wb") as f:
+                plistlib.dump(changed, f)
+            with patch(
+                "autopkglib.recipe_from_file", wraps=autopkglib.recipe_from_file
+            ) as mock_read:
+                index = autopkglib.RecipeIndex(index_path)
+                found = index.find_by_identifier("com.example.changed", [recipes_dir])
+            self.assertEqual(found, munki_path)
+            mock_read.assert_called_once_with(munki_path)
+
+    def test_yaml_recipe_parse_is_cached(self):
+        """recipe_from_file should reuse the cached parse of an unchanged
+        yaml recipe."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            recipe_path = os.path.join(tmp_dir, "Test.recipe.yaml")
+            with open(recipe_path, "w") as f:
+                f.write("Identifier: com.example.test\nInput:\n  NAME: Test\n")
+            with patch("autopkglib.get_pref", return_value=tmp_dir):
+                recipe = autopkglib.recipe_from_file(recipe_path)
+                with patch("yaml.load") as mock_load:
+                    self.assertEqual(autopkglib.recipe_from_file(recipe_path), recipe)
+                mock_load.assert_not_called()
+                with open(recipe_path, "a") as f:
+                    f.write("MinimumVersion: '2.3'\n")
+                self.assertEqual(
+                    autopkglib.recipe_from_file(recipe_path)["MinimumVersion"], "2.3"
+                )
+            self.assertEqual(
+                recipe, {"Identifier": "com.example.test", "Input": {"NAME": "Test"}}
+            )
+
+    def test_prune_compiled_recipes_removes_unused_parses(self):
+        """prune_compiled_recipes should only remove parses that haven't been
+        used for a while."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            old_path = os.path.join(tmp_dir, "old.marshal")
+            new_path = os.path.join(tmp_dir, "new.marshal")
+            for path in (old_path, new_path):
+                with open(path, "wb") as f:
+                    f.write(b"")
+            os.utime(old_path, (1, 1))
+            autopkglib.prune_compiled_recipes(tmp_dir)
+            self.assertEqual(os.listdir(tmp_dir), ["new.marshal"])
+
+    def test_file_hash_cache_only_rehashes_changed_files(self):
+        """FileHashCache should reuse saved hashes for unchanged files."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_path = os.path.join(tmp_dir, "sha256_cache.json")
+            recipe_path = self._write_recipe(
+                tmp_dir,
+                "GoogleChrome.download.recipe",
+                plistlib.loads(self.download_recipe.encode("utf-8")),
+            )
+            # make the file old enough to be cached
+            os.utime(recipe_path, (1, 1))
+            cache = autopkglib.FileHashCache(cache_path)
+            digest = cache.sha256(recipe_path)
+            cache.save()
+            self.assertTrue(os.path.exists(cache_path))
+
+            with patch("autopkglib.hashlib.sha256") as mock_sha256:
+                cache = autopkglib.FileHashCache(cache_path)
+                self.assertEqual(cache.sha256(recipe_path), digest)
+            mock_sha256.assert_not_called()
+
+            with open(recipe_path, "ab") as f:
+                f.write(b"\n")
+            os.utime(recipe_path, (1, 1))
+            self.assertNotEqual(cache.sha256(recipe_path), digest)
+            self.assertIsNone(cache.sha256(os.path.join(tmp_dir, "missing")))
+
+    def test_atomic_write_leaves_no_partial_file(self):
+        """atomic_write should keep the old file if writing the new one
+        fails, and clean up after itself."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "cache", "entry.json")
+            autopkglib.atomic_write(path, lambda f: f.write("old"), binary=False)
+
+            def fail(f):
+                f.write("partial")
+                raise ValueError("can't serialise")
+
+            with self.assertRaises(ValueError):
+                autopkglib.atomic_write(path, fail, binary=False)
+            with open(path) as f:
+                self.assertEqual(f.read(), "old")
+            self.assertEqual(os.listdir(os.path.dirname(path)), ["entry.json"])
+
+    @unittest.skipUnless(autopkg.git_cmd(), "git is not installed")
+    def test_git_metadata_commit_hashes(self):
+        """GitMetadata should find the last commit of unchanged files only."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = os.path.realpath(tmp_dir)
+            git_env = ["-c", "user.name=Test", "-c", "user.email=test@example.com"]
+            autopkg.run_git(["init", "-q"], git_directory=tmp_dir)
+            paths = []
+            for name in ("first.recipe", "second.recipe"):
+                paths.append(os.path.join(tmp_dir, name))
+                with open(paths[-1], "w") as f:
+                    f.write(name)
+                autopkg.run_git(["add", name], git_directory=tmp_dir)
+                autopkg.run_git(
+                    git_env + ["commit", "-q", "-m", name], git_directory=tmp_dir
+                )
+            commits = autopkg.run_git(
+                ["log", "--format=%H"], git_directory=tmp_dir
+            ).split()
+            untracked = os.path.join(tmp_dir, "untracked.recipe")
+            with open(untracked, "w") as f:
+                f.write("untracked")
+
+            git_metadata = autopkg.GitMetadata()
+            self.assertEqual(
+                git_metadata.commit_hashes(paths + [untracked]),
+                {paths[0]: commits[1], paths[1]: commits[0], untracked: None},
+            )
+            with open(paths[0], "a") as f:
+                f.write("changed")
+            # answers are cached until invalidated
+            self.assertEqual(git_metadata.commit_hashes(paths)[paths[0]], commits[1])
+            git_metadata.invalidate()
+            self.assertIsNone(git_metadata.commit_hashes(paths)[paths[0]])
+
+    def test_load_recipe_reuses_parsed_parent_chain(self):
+        """load_recipe should parse each file in a parent chain only once and
+        hand out independent copies of the merged recipe."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            recipes_dir = os.path.join(tmp_dir, "recipes")
+            self._write_recipe(
+                recipes_dir,
+                "GoogleChrome.download.recipe",
+                plistlib.loads(self.download_recipe.encode("utf-8")),
+            )
+            self._write_recipe(
+                recipes_dir,
+                "GoogleChrome.munki.recipe",
+                plistlib.loads(self.munki_recipe.encode("utf-8")),
+            )
+            autopkg._parsed_recipe_cache.clear()
+            autopkg._merged_recipe_cache.clear()
+            with patch(
+                "autopkg.get_recipe_index",
+                return_value=autopkglib.RecipeIndex(
+                    os.path.join(tmp_dir, "index.json")
+                ),
+            ), patch(
+                "autopkg.recipe_from_file", wraps=autopkglib.recipe_from_file
+            ) as mock_read:
+                first = autopkg.load_recipe(
+                    "GoogleChrome.munki",
+                    [],
+                    [recipes_dir],
+                    make_suggestions=False,
+                    search_github=False,
+                )
+                first["Process"].clear()
+                second = autopkg.load_recipe(
+                    "GoogleChrome.munki",
+                    [],
+                    [recipes_dir],
+                    make_suggestions=False,
+                    search_github=False,
+                )
+            self.assertEqual(mock_read.call_count, 2)
+            self.assertEqual(len(second["Process"]), 4)
+            self.assertEqual(len(second["PARENT_RECIPES"]), 1)
+            self.assertEqual(second["name"], "GoogleChrome.munki")
+
+    def test_parsed_recipe_cache_notices_changed_files(self):
+        """A recipe file is parsed again once it changes."""
+        # other tests change the class's recipe dicts
+        download_struct = plistlib.loads(self.download_recipe.encode("utf-8"))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            recipe_path = self._write_recipe(
+                tmp_dir, "GoogleChrome.download.recipe", download_struct
+            )
+            autopkg._parsed_recipe_cache.clear()
+            with patch(
+                "autopkg.recipe_from_file", wraps=autopkglib.recipe_from_file
+            ) as mock_read:
+                autopkg.parsed_recipe_file(recipe_path)
+                autopkg.parsed_recipe_file(recipe_path)
+                self.assertEqual(mock_read.call_count, 1)
+                self._write_recipe(
+                    tmp_dir,
+                    "GoogleChrome.download.recipe",
+                    dict(download_struct, Identifier="com.example.changed"),
+                )
+                os.utime(recipe_path, ns=(1, 1))
+                recipe = autopkg.parsed_recipe_file(recipe_path)
+                self.assertEqual(mock_read.call_count, 2)
+            self.assertEqual(recipe["Identifier"], "com.example.changed")
+            self.assertIs(autopkg._parsed_recipe_cache[recipe_path][1], recipe)
+
+    def test_merged_recipe_cache_notices_changed_parents(self):
+        """A merged recipe is merged again once any recipe in its parent chain
+        changes."""
+        download_struct = plistlib.loads(self.download_recipe.encode("utf-8"))
+        munki_struct = plistlib.loads(self.munki_recipe.encode("utf-8"))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            recipes_dir = os.path.join(tmp_dir, "recipes")
+            download_path = self._write_recipe(
+                recipes_dir, "GoogleChrome.download.recipe", download_struct
+            )
+            self._write_recipe(recipes_dir, "GoogleChrome.munki.recipe", munki_struct)
+            autopkg._parsed_recipe_cache.clear()
+            autopkg._merged_recipe_cache.clear()
+
+            def load():
+                return autopkg.load_recipe(
+                    "GoogleChrome.munki",
+                    [],
+                    [recipes_dir],
+                    make_suggestions=False,
+                    search_github=False,
+                )
+
+            with patch(
+                "autopkg.get_recipe_index",
+                return_value=autopkglib.RecipeIndex(
+                    os.path.join(tmp_dir, "index.json")
+                ),
+            ):
+                self.assertEqual(len(load()["Process"]), 4)
+                self._write_recipe(
+                    recipes_dir,
+                    "GoogleChrome.download.recipe",
+                    dict(download_struct, Process=[]),
+                )
+                os.utime(download_path, ns=(1, 1))
+                self.assertEqual(len(load()["Process"]), 1)
+                # and the new merge is what's reused
+                self.assertEqual(len(load()["Process"]), 1)
+
+    def test_skip_unchanged_replays_last_run(self):
+        """With SKIP_UNCHANGED, the steps after an unchanged download only run
+        until a run with the same inputs has succeeded."""
+
+        class UnchangedDownload(autopkglib.Processor):
+            input_variables = {}
+            output_variables = {"download_changed": {"description": ""}}
+
+            def main(self):
+                self.env["download_changed"] = False
+
+        class Importer(autopkglib.Processor):
+            input_variables = {}
+            output_variables = {"imported_version": {"description": ""}}
+            runs = 0
+
+            def main(self):
+                type(self).runs += 1
+                self.env["imported_version"] = "1.0"
+
+        autopkglib.add_processor("UnchangedDownload", UnchangedDownload)
+        autopkglib.add_processor("Importer", Importer)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            recipe_path = os.path.join(tmp_dir, "Test.recipe")
+            with open(recipe_path, "w") as f:
+                f.write("recipe")
+            recipe = {
+                "Identifier": "com.example.skip",
+                "Input": {},
+                "Process": [
+                    {"Processor": "UnchangedDownload"},
+                    {"Processor": "Importer"},
+                ],
+                "RECIPE_PATH": recipe_path,
+            }
+
+            def run(**env):
+                autopackager = autopkglib.AutoPackager(
+                    type("Options", (), {"verbose": 0}),
+                    dict(env, CACHE_DIR=tmp_dir, SKIP_UNCHANGED=True),
+                )
+                autopackager.process(recipe)
+                return autopackager
+
+            run()
+            replayed = run()
+            self.assertEqual(Importer.runs, 1)
+            self.assertEqual(replayed.env["imported_version"], "1.0")
+            self.assertEqual(replayed.results[-1]["Processor"], "Importer")
+            # Different inputs run every step again
+            run(NAME="Other")
+            self.assertEqual(Importer.runs, 2)
+            # Objects and URL signatures, which differ every run, are ignored
+            run(url="https://example.com/Test.dmg?sig=1", handle=object())
+            run(url="https://example.com/Test.dmg?sig=2", handle=object())
+            self.assertEqual(Importer.runs, 3)
+
+    def test_replayed_run_reports_no_work(self):
+        """A replayed run didn't import anything, so it shouldn't report
+        summary results or changes."""
+
+        class UnchangedDownload(autopkglib.Processor):
+            input_variables = {}
+            output_variables = {"download_changed": {"description": ""}}
+
+            def main(self):
+                self.env["download_changed"] = False
+
+        class SummaryImporter(autopkglib.Processor):
+            input_variables = {}
+            output_variables = {
+                "munki_repo_changed": {"description": ""},
+                "importer_summary_result": {"description": ""},
+                "pkginfo_path": {"description": ""},
+            }
+
+            def main(self):
+                self.env["munki_repo_changed"] = True
+                self.env["importer_summary_result"] = {
+                    "summary_text": "Imported:",
+                    "data": {"name": "Test"},
+                }
+                self.env["pkginfo_path"] = "pkgsinfo/Test.plist"
+
+        autopkglib.add_processor("UnchangedDownload", UnchangedDownload)
+        autopkglib.add_processor("SummaryImporter", SummaryImporter)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            recipe_path = os.path.join(tmp_dir, "Test.recipe")
+            with open(recipe_path, "w") as f:
+                f.write("recipe")
+            recipe = {
+                "Identifier": "com.example.summary",
+                "Input": {},
+                "Process": [
+                    {"Processor": "UnchangedDownload"},
+                    {"Processor": "SummaryImporter"},
+                ],
+                "RECIPE_PATH": recipe_path,
+            }
+            runs = []
+            for _ in range(2):
+                autopackager = autopkglib.AutoPackager(
+                    type("Options", (), {"verbose": 0}),
+                    {"CACHE_DIR": tmp_dir, "SKIP_UNCHANGED": True},
+                )
+                autopackager.process(recipe)
+                runs.append(autopackager)
+        first, replayed = runs
+        summary_results = {}
+        autopkg.collect_summary_results(first.results, summary_results)
+        self.assertIn("importer_summary_result", summary_results)
+        summary_results = {}
+        autopkg.collect_summary_results(replayed.results, summary_results)
+        self.assertEqual(summary_results, {})
+        self.assertEqual(replayed.env["pkginfo_path"], "pkgsinfo/Test.plist")
+        self.assertNotIn("munki_repo_changed", replayed.env)
+        self.assertNotIn("importer_summary_result", replayed.env)
+
+    def test_update_fingerprint_leaves_preferences_alone(self):
+        """Fingerprinting a LayeredEnv shouldn't copy preferences into it."""
+        env = autopkglib.LayeredEnv({"PREF_LIST": ["a", "b"]}, {"NAME": "Test"})
+        autopackager = autopkglib.AutoPackager(type("Options", (), {"verbose": 0}), env)
+        autopackager.update_fingerprint(autopkglib.hashlib.sha256())
+        self.assertNotIn("PREF_LIST", env.changes())
+
+    def test_step_cache_reuses_unchanged_steps(self):
+        """With STEP_CACHE, cacheable steps run again only when their inputs
+        or the files they refer to change."""
+
+        class ReadVersion(autopkglib.Processor):
+            cacheable = True
+            input_variables = {"version_file": {"required": True}}
+            output_variables = {"version": {"description": ""}}
+            runs = 0
+
+            def main(self):
+                type(self).runs += 1
+                with open(self.env["version_file"]) as f:
+                    self.env["version"] = f.read()
+
+        autopkglib.add_processor("ReadVersion", ReadVersion)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            version_file = os.path.join(tmp_dir, "version.txt")
+            with open(version_file, "w") as f:
+                f.write("1.0")
+            recipe = {
+                "Identifier": "com.example.stepcache",
+                "Input": {},
+                "Process": [
+                    {
+                        "Processor": "ReadVersion",
+                        "Arguments": {"version_file": version_file},
+                    }
+                ],
+            }
+
+            def run():
+                autopackager = autopkglib.AutoPackager(
+                    type("Options", (), {"verbose": 0}),
+                    {"CACHE_DIR": tmp_dir, "STEP_CACHE": True},
+                )
+                autopackager.process(recipe)
+                return autopackager.env["version"]
+
+            self.assertEqual(run(), "1.0")
+            self.assertEqual(run(), "1.0")
+            self.assertEqual(ReadVersion.runs, 1)
+            with open(version_file, "w") as f:
+                f.write("2.0")
+            os.utime(version_file, ns=(1, 1))
+            self.assertEqual(run(), "2.0")
+            self.assertEqual(ReadVersion.runs, 2)
+            # Results from another version of AutoPkg aren't reused
+            with patch("autopkglib.get_autopkg_version", return_value="0.0.1"):
+                self.assertEqual(run(), "2.0")
+            self.assertEqual(ReadVersion.runs, 3)
+
+    def test_resource_usage_measures_work(self):
+        """ResourceUsage records at least wall and CPU time."""
+        with autopkglib.ResourceUsage() as usage:
+            sum(range(100000))
+            subprocess.run([sys.executable, "-c", "pass"], check=True)
+        self.assertGreater(usage.metrics["wall_time"], 0)
+        self.assertGreater(usage.metrics["cpu_time"], 0)
+        if autopkglib.resource is not None:
+            self.assertGreater(usage.metrics["child_cpu_time"], 0)
+
+    @unittest.skipIf(autopkglib.resource is None, "needs the resource module")
+    def test_resource_usage_counts_blocks_without_proc(self):
+        """Without /proc, as on macOS, I/O is measured in blocks."""
+        with patch("builtins.open", side_effect=OSError):
+            counters = autopkglib.ResourceUsage._io_counters()
+        self.assertEqual(set(counters), {"blocks_read", "blocks_written"})
+
+    def test_metrics_file_written_from_run_metrics(self):
+        """Run metrics are written as Prometheus counters and histograms."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pathname = os.path.join(tmp_dir, "Foo.dmg")
+            with open(pathname, "wb") as f:
+                f.write(b"x" * 10)
+            results = [
+                {
+                    "Processor": "URLDownloader",
+                    "Output": {"download_changed": True, "pathname": pathname},
+                    "Metrics": {"wall_time": 0.2},
+                },
+                {"Processor": "com.example/Custom", "Metrics": {"wall_time": 20}},
+            ]
+            recipe_metrics = {
+                "trust_verification": {"wall_time": 0.05},
+                "http_cache": {"hits": 3, "misses": 1},
+                "github_rate_limit_remaining": 42,
+            }
+            run_metrics = [
+                autopkg.collect_run_metrics(
+                    "Foo.download", results, {}, recipe_metrics
+                ),
+                autopkg.collect_run_metrics(
+                    "Bar.download",
+                    [{"Processor": "URLDownloader", "Metrics": {"wall_time": 0.7}}],
+                    {},
+                ),
+            ]
+            summary_results = {"url_downloader_summary_result": {"data_rows": [{}]}}
+            metrics_file = os.path.join(tmp_dir, "autopkg.prom")
+            autopkg.write_metrics_file(
+                metrics_file,
+                autopkg.format_metrics(run_metrics, [{}], summary_results),
+            )
+            with open(metrics_file) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ["Foo.dmg", "autopkg.prom"])
+        for line in [
+            "autopkg_recipes_total 2",
+            "autopkg_recipes_failed_total 1",
+            'autopkg_downloads_total{result="changed"} 1',
+            'autopkg_downloads_total{result="unchanged"} 1',
+            "autopkg_downloaded_bytes_total 10",
+            'autopkg_http_cache_lookups_total{result="hit"} 3',
+            'autopkg_summary_rows_total{summary="url_downloader"} 1',
+            'autopkg_processor_duration_seconds_bucket{processor="URLDownloader",le="0.5"} 1',
+            'autopkg_processor_duration_seconds_count{processor="URLDownloader"} 2',
+            'autopkg_processor_duration_seconds_bucket{processor="com.example/Custom",le="10"} 0',
+            'autopkg_trust_verification_duration_seconds_bucket{le="0.1"} 1',
+            "autopkg_github_rate_limit_remaining 42",
+            "autopkg_run_in_progress 0",
+        ]:
+            self.assertIn(line, lines)
+
+    def _run_recipes(self, tmp_dir, args, delays):
+        """Run run_recipes() with args on a recipe for each of delays, which
+        take that many seconds. A negative delay fails, and a recipe with a
+        delay of None can't be loaded. Returns the exit code, the lines
+        logged and the report plist."""
+
+        class Sleeper(autopkglib.Processor):
+            input_variables = {"delay": {"required": True}}
+            output_variables = {"download_changed": {"description": ""}}
+
+            def main(self):
+                if self.env["delay"] < 0:
+                    raise autopkglib.ProcessorError("failed on purpose")
+                time.sleep(self.env["delay"])
+                self.env["download_changed"] = self.env["delay"] > 0
+
+        autopkglib.add_processor("Sleeper", Sleeper)
+        # pick up the classes of the autopkglib reloaded by setUp()
+        imp.load_source("autopkg", autopkg.__file__)
+        recipes = {}
+        for index, delay in enumerate(delays):
+            recipe_path = os.path.join(tmp_dir, f"Test{index}.recipe")
+            if delay is None:
+                recipes[recipe_path] = None
+                continue
+            recipes[recipe_path] = {
+                "Identifier": f"com.example.test{index}",
+                "Input": {},
+                "Process": [
+                    {"Processor": "Sleeper", "Arguments": {"delay": delay}},
+                    {"Processor": "EndOfCheckPhase"},
+                ],
+                "RECIPE_PATH": recipe_path,
+            }
+        report_plist = os.path.join(tmp_dir, "report.plist")
+        logged = []
+        with patch.object(
+            autopkglib.globalPreferences, "prefs", {"CACHE_DIR": tmp_dir}
+        ), patch.object(
+            autopkg,
+            "load_recipe",
+            side_effect=lambda path, *args, **kwargs: recipes[path],
+        ), patch.object(
+            autopkg, "log", side_effect=lambda msg, error=False: logged.append(msg)
+        ), patch.object(
+            autopkg, "log_err", side_effect=logged.append
+        ):
+            exit_code = autopkg.run_recipes(
+                ["autopkg", "run", "--report-plist", report_plist]
+                + args
+                + list(recipes)
+            )
+        with open(report_plist, "rb") as f:
+            report = plistlib.load(f)
+        return exit_code, logged, report
+
+    def test_check_in_threads_matches_serial_check(self):
+        """Checking recipes in threads reports results and failures in
+        recipe order, the same way as checking them one at a time."""
+        delays = [0.3, -1, 0.1, 0]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            serial = self._run_recipes(tmp_dir, ["--check"], delays)
+            threaded = self._run_recipes(tmp_dir, ["--check", "--jobs", "4"], delays)
+        for exit_code, logged, report in (serial, threaded):
+            self.assertEqual(exit_code, autopkg.RECIPE_FAILED_CODE)
+            check_results = logged[logged.index("\nCheck results:") + 1 :]
+            self.assertEqual(
+                [line.split()[0] for line in check_results[:4]],
+                ["changed", "failed", "changed", "unchanged"],
+            )
+            self.assertEqual(
+                [os.path.basename(item["recipe"]) for item in report["failures"]],
+                ["Test1.recipe"],
+            )
+            self.assertEqual(
+                [os.path.basename(item["recipe"]) for item in report["metrics"]],
+                ["Test0.recipe", "Test1.recipe", "Test2.recipe", "Test3.recipe"],
+            )
+        self.assertEqual(serial[2]["failures"], threaded[2]["failures"])
+
+    def test_check_without_results_logs_no_header(self):
+        """No check results are reported when no recipe could be checked."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            exit_code, logged, _report = self._run_recipes(tmp_dir, ["--check"], [None])
+        self.assertEqual(exit_code, autopkg.RECIPE_FAILED_CODE)
+        self.assertNotIn("\nCheck results:", logged)
+
+    @unittest.skipUnless(
+        multiprocessing.get_start_method() == "fork",
+        "worker processes need the test processors of this one",
+    )
+    def test_jobs_in_processes_match_serial_run(self):
+        """Running recipes in worker processes records results and failures
+        in recipe order, with the same exit code as a serial run, and the
+        workers use the search dirs given."""
+        delays = [0.3, -1, 0.1, 0]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            search_dir = os.path.join(tmp_dir, "Recipes")
+            args = ["--search-dir", search_dir]
+            serial = self._run_recipes(tmp_dir, args, delays)
+            parallel = self._run_recipes(tmp_dir, args + ["--jobs", "4"], delays)
+            with open(os.path.join(tmp_dir, "autopkg_results.plist"), "rb") as f:
+                run_results = plistlib.load(f)
+        for exit_code, _logged, report in (serial, parallel):
+            self.assertEqual(exit_code, autopkg.RECIPE_FAILED_CODE)
+            self.assertEqual(
+                [os.path.basename(item["recipe"]) for item in report["failures"]],
+                ["Test1.recipe"],
+            )
+            self.assertEqual(
+                [os.path.basename(item["recipe"]) for item in report["metrics"]],
+                ["Test0.recipe", "Test1.recipe", "Test2.recipe", "Test3.recipe"],
+            )
+        self.assertEqual(serial[2]["failures"], parallel[2]["failures"])
+        self.assertEqual(
+            [results[0]["Recipe input"]["RECIPE_PATH"] for results in run_results],
+            [item["recipe"] for item in parallel[2]["metrics"]],
+        )
+        for results in run_results:
+            self.assertEqual(
+                results[0]["Recipe input"]["RECIPE_SEARCH_DIRS"], [search_dir]
+            )
+
+    def test_init_recipe_worker_restores_parent_state(self):
+        """Worker processes start with the preferences, and so the search
+        dirs, and the run id of the parent process."""
+        run_id = autopkglib.get_run_id()
+        imp.load_source("autopkg", autopkg.__file__)
+        prefs = {"CACHE_DIR": "/cache", "RECIPE_SEARCH_DIRS": ["/recipes"]}
+        try:
+            with patch.object(autopkglib.globalPreferences, "prefs", {}):
+                autopkg.init_recipe_worker(prefs, "parent-run")
+                self.assertEqual(autopkglib.get_pref("CACHE_DIR"), "/cache")
+                self.assertEqual(autopkg.get_search_dirs(), ["/recipes"])
+                self.assertEqual(autopkglib.get_run_id(), "parent-run")
+        finally:
+            autopkglib.set_run_id(run_id)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,414 @@
+#!/usr/local/autopkg/python
+
+import hashlib
+import http.server
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from autopkglib import ProcessorError, xattr
+from autopkglib.URLDownloader import DownloadCoordinator, DownloadStore, URLDownloader
+
+BODY = bytes(range(256)) * 400
+ETAG = '"v1"'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Serves BODY with Range support. /flaky drops the connection partway
+    through, /norange ignores Range headers."""
+
+    protocol_version = "HTTP/1.1"
+    ranges = []
+    requests = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        type(self).requests += 1
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.send_header("ETag", ETAG)
+            self.end_headers()
+            return
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if range_header and self.path != "/norange" and if_range in (None, ETAG):
+            start, _, end = range_header.split("=")[1].partition("-")
+            start, end = int(start), int(end or len(BODY) - 1)
+            type(self).ranges.append((start, end))
+            self.send_response(206)
+            self.send_header("ETag", ETAG)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(BODY)}")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            self.wfile.write(BODY[start : end + 1])
+            return
+        self.send_response(200)
+        self.send_header("ETag", ETAG)
+        if self.path == "/named":
+            self.send_header("Content-Disposition", 'attachment; filename="real.bin"')
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        if self.path == "/flaky":
+            self.wfile.write(BODY[:40000])
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.close_connection = True
+            return
+        self.wfile.write(BODY)
+
+
+class TestURLDownloader(unittest.TestCase):
+    """Test class for URLDownloader Processor."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.pathname = os.path.join(self.tmp_dir.name, "item.bin")
+        # Each download gets its own coordinator unless a test shares one
+        patcher = patch(
+            "autopkglib.URLDownloader.get_download_coordinator",
+            side_effect=DownloadCoordinator,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_processor(self, path, segments=1, download_dir=None, **env):
+        processor = URLDownloader(
+            {
+                "HTTP_TRANSPORT": "pool",
+                **env,
+                "url": self.base_url + path,
+                "filename": "item.bin",
+                "download_dir": download_dir or self.tmp_dir.name,
+                "RECIPE_CACHE_DIR": self.tmp_dir.name,
+                "CHECK_FILESIZE_ONLY": False,
+                "download_segments": segments,
+                "verbose": 0,
+            }
+        )
+        processor.main()
+        return processor
+
+    def interrupted_download(self):
+        with self.assertRaises(ProcessorError):
+            self.run_processor("/flaky")
+        self.assertEqual(os.path.getsize(self.pathname + ".partial"), 40000)
+
+    def test_interrupted_download_is_resumed(self):
+        """The next attempt asks only for the bytes that are missing."""
+        self.interrupted_download()
+        processor = self.run_processor("/complete")
+        self.assertEqual(processor.resume_from, 40000)
+        with open(self.pathname, "rb") as f:
+            self.assertEqual(f.read(), BODY)
+        self.assertFalse(os.path.exists(self.pathname + ".partial"))
+        self.assertEqual(
+            processor.env["download_sha256"], hashlib.sha256(BODY).hexdigest()
+        )
+
+    def test_resume_falls_back_to_full_download(self):
+        """A server that ignores Range gets a fresh full download."""
+        self.interrupted_download()
+        self.run_processor("/norange")
+        with open(self.pathname, "rb") as f:
+            self.assertEqual(f.read(), BODY)
+
+    @patch("autopkglib.URLDownloader.MIN_SEGMENT_SIZE", 10000)
+    def test_segmented_download(self):
+        """Segments are fetched with separate range requests and assembled
+        in place."""
+        _Handler.ranges = []
+        processor = self.run_processor("/complete", segments=4)
+        self.assertTrue(processor.env["download_changed"])
+        self.assertEqual(len(_Handler.ranges), 4)
+        with open(self.pathname, "rb") as f:
+            self.assertEqual(f.read(), BODY)
+
+    @patch("autopkglib.URLDownloader.MIN_SEGMENT_SIZE", 10000)
+    def test_segmented_download_falls_back_to_single_request(self):
+        """A server that ignores Range gets a single full download."""
+        _Handler.ranges = []
+        self.run_processor("/norange", segments=4)
+        self.assertEqual(_Handler.ranges, [])
+        with open(self.pathname, "rb") as f:
+            self.assertEqual(f.read(), BODY)
+
+    @unittest.skipUnless(os.path.exists("/usr/bin/curl"), "needs curl")
+    @patch("autopkglib.URLDownloader.MIN_SEGMENT_SIZE", 10000)
+    def test_segmented_download_warns_without_pool(self):
+        """Segments need the pool transport; curl gets a single request."""
+        _Handler.ranges = []
+        with patch.object(URLDownloader, "output") as output:
+            self.run_processor(
+                "/complete",
+                segments=4,
+                CURL_PATH="/usr/bin/curl",
+                HTTP_TRANSPORT="curl",
+            )
+        self.assertEqual(_Handler.ranges, [])
+        self.assertTrue(
+            any(
+                "WARNING: download_segments requires HTTP_TRANSPORT" in call.args[0]
+                for call in output.call_args_list
+            )
+        )
+        with open(self.pathname, "rb") as f:
+            self.assertEqual(f.read(), BODY)
+
+    def test_hashes_computed_while_downloading(self):
+        """Hashes come from the download itself and are stored with it."""
+        processor = self.run_processor("/complete")
+        self.assertIsNotNone(processor.download_hashes)
+        self.assertEqual(
+            processor.env["download_sha256"], hashlib.sha256(BODY).hexdigest()
+        )
+        self.assertEqual(
+            processor.stored_hashes(), {"sha256": hashlib.sha256(BODY).hexdigest()}
+        )
+
+    @unittest.skipUnless(os.path.exists("/usr/bin/curl"), "needs curl")
+    def test_hashes_computed_while_downloading_with_curl(self):
+        """curl's output is hashed as it is written, and a resumed download
+        hashes only the bytes it already had."""
+        env = {"CURL_PATH": "/usr/bin/curl", "HTTP_TRANSPORT": "curl"}
+        with patch.object(
+            URLDownloader,
+            "hash_file",
+            side_effect=URLDownloader.hash_file,
+            autospec=True,
+        ) as hash_file:
+            processor = self.run_processor("/complete", **env)
+        hash_file.assert_not_called()
+        self.assertEqual(
+            processor.env["download_sha256"], hashlib.sha256(BODY).hexdigest()
+        )
+        self.assertEqual(processor.env["etag"], ETAG)
+
+        os.remove(self.pathname)
+        with self.assertRaises(ProcessorError):
+            self.run_processor("/flaky", **env)
+        self.assertEqual(os.path.getsize(self.pathname + ".partial"), 40000)
+        with patch.object(
+            URLDownloader,
+            "hash_file",
+            side_effect=URLDownloader.hash_file,
+            autospec=True,
+        ) as hash_file:
+            processor = self.run_processor("/complete", **env)
+        hash_file.assert_called_once()
+        self.assertEqual(processor.resume_from, 40000)
+        with open(self.pathname, "rb") as f:
+            self.assertEqual(f.read(), BODY)
+        self.assertEqual(
+            processor.env["download_sha256"], hashlib.sha256(BODY).hexdigest()
+        )
+
+    def test_filename_from_download_headers(self):
+        """prefetch_filename names the download after its own headers, and
+        the next run revalidates that file without an extra request."""
+        before = _Handler.requests
+        processor = self.run_processor("/named", prefetch_filename=True)
+        self.assertEqual(_Handler.requests, before + 1)
+        real_pathname = os.path.join(self.tmp_dir.name, "real.bin")
+        self.assertEqual(processor.env["pathname"], real_pathname)
+        with open(real_pathname, "rb") as f:
+            self.assertEqual(f.read(), BODY)
+        self.assertFalse(os.path.exists(self.pathname))
+        processor = self.run_processor("/named", prefetch_filename=True)
+        self.assertEqual(_Handler.requests, before + 2)
+        self.assertFalse(processor.env["download_changed"])
+        self.assertEqual(processor.env["pathname"], real_pathname)
+
+    def test_filename_prefetched_after_upgrade(self):
+        """An item downloaded by a version that didn't remember filenames is
+        found with a separate request and revalidated, not downloaded
+        again."""
+        processor = self.run_processor("/named", prefetch_filename=True)
+        xattr.removexattr(self.tmp_dir.name, processor.xattr_filename)
+        before = _Handler.requests
+        processor = self.run_processor("/named", prefetch_filename=True)
+        self.assertEqual(_Handler.requests, before + 2)
+        self.assertFalse(processor.env["download_changed"])
+        self.assertEqual(
+            processor.env["pathname"], os.path.join(self.tmp_dir.name, "real.bin")
+        )
+        self.assertFalse(os.path.exists(self.pathname))
+        # The filename is remembered from then on
+        processor = self.run_processor("/named", prefetch_filename=True)
+        self.assertEqual(_Handler.requests, before + 3)
+        self.assertFalse(processor.env["download_changed"])
+
+    def test_filename_from_download_headers_without_xattr_support(self):
+        """prefetch_filename still works with a backend that returns None
+        for missing attributes, as ADS and the no-op stub do."""
+        with patch("autopkglib.URLDownloader.xattr") as mock_xattr:
+            mock_xattr.listxattr.return_value = []
+            mock_xattr.getxattr.return_value = None
+            for _ in range(2):
+                processor = self.run_processor("/named", prefetch_filename=True)
+                self.assertEqual(
+                    processor.env["pathname"],
+                    os.path.join(self.tmp_dir.name, "real.bin"),
+                )
+
+    def test_download_store_shared_between_recipes(self):
+        """A second recipe copies the stored item and only revalidates it."""
+        store = DownloadStore(os.path.join(self.tmp_dir.name, "store"), 2**30)
+        other_dir = os.path.join(self.tmp_dir.name, "other")
+        with patch("autopkglib.URLDownloader.get_download_store", return_value=store):
+            self.run_processor("/complete")
+            before = _Handler.requests
+            processor = self.run_processor("/complete", download_dir=other_dir)
+        self.assertEqual(_Handler.requests, before + 1)
+        self.assertTrue(processor.env["download_changed"])
+        other_pathname = os.path.join(other_dir, "item.bin")
+        self.assertEqual(
+            processor.env["download_sha256"], hashlib.sha256(BODY).hexdigest()
+        )
+        # Changing one recipe's item leaves the store and other recipes alone
+        self.assertFalse(os.path.samefile(self.pathname, other_pathname))
+        with open(other_pathname, "ab") as f:
+            f.write(b"changed")
+        for path in (self.pathname, store.lookup(self.base_url + "/complete")):
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), BODY)
+
+    def test_downloads_coalesced_within_run(self):
+        """Recipes downloading the same URL in a run share one transfer,
+        but different request headers get their own."""
+        coordinator = DownloadCoordinator()
+        other_dir = os.path.join(self.tmp_dir.name, "other")
+        with patch(
+            "autopkglib.URLDownloader.get_download_coordinator",
+            return_value=coordinator,
+        ), patch("autopkglib.URLDownloader.is_concurrent_run", return_value=True):
+            before = _Handler.requests
+            self.run_processor("/complete")
+            processor = self.run_processor("/complete", download_dir=other_dir)
+            self.assertEqual(_Handler.requests, before + 1)
+            self.assertTrue(processor.env["download_changed"])
+            self.assertEqual(processor.env["etag"], ETAG)
+            with open(os.path.join(other_dir, "item.bin"), "rb") as f:
+                self.assertEqual(f.read(), BODY)
+            # Downloading it again in the same run changes nothing
+            processor = self.run_processor("/complete", download_dir=other_dir)
+            self.assertFalse(processor.env["download_changed"])
+            self.assertEqual(_Handler.requests, before + 1)
+            processor = URLDownloader(
+                {
+                    "url": self.base_url + "/complete",
+                    "filename": "item.bin",
+                    "download_dir": os.path.join(self.tmp_dir.name, "auth"),
+                    "request_headers": {"Authorization": "Bearer 1"},
+                    "CHECK_FILESIZE_ONLY": False,
+                    "verbose": 0,
+                }
+            )
+            processor.main()
+            self.assertEqual(_Handler.requests, before + 2)
+
+    def test_downloads_coalesced_across_processes(self):
+        """Coordinators sharing a claims directory, like the worker processes
+        of a run, download each URL once; later runs download it again."""
+        claims_dir = os.path.join(self.tmp_dir.name, "claims")
+        other_dir = os.path.join(self.tmp_dir.name, "other")
+        with patch(
+            "autopkglib.URLDownloader.get_download_coordinator",
+            side_effect=lambda: DownloadCoordinator(claims_dir),
+        ), patch("autopkglib.URLDownloader.is_concurrent_run", return_value=True):
+            before = _Handler.requests
+            self.run_processor("/complete")
+            processor = self.run_processor("/complete", download_dir=other_dir)
+            self.assertEqual(_Handler.requests, before + 1)
+            self.assertTrue(processor.env["download_changed"])
+            with patch("autopkglib.URLDownloader.get_run_id", return_value="next"):
+                self.run_processor("/complete", download_dir=other_dir)
+            self.assertEqual(_Handler.requests, before + 2)
+
+    def test_claim_waits_for_other_process(self):
+        """A claim waits while another process is downloading the URL."""
+        claims_dir = os.path.join(self.tmp_dir.name, "claims")
+        download, first = DownloadCoordinator(claims_dir).claim("https://x/item")
+        self.assertTrue(first)
+        claimed = []
+        waiter = threading.Thread(
+            target=lambda: claimed.append(
+                DownloadCoordinator(claims_dir).claim("https://x/item")
+            )
+        )
+        waiter.start()
+        waiter.join(0.2)
+        self.assertEqual(claimed, [])
+        download.finish(None)
+        waiter.join(5)
+        self.assertTrue(claimed[0][1])
+        claimed[0][0].finish(None)
+
+    def test_claims_of_other_urls_dont_wait(self):
+        """Each URL has its own claim file, so a download in another process
+        holds up only claims of the same URL."""
+        claims_dir = os.path.join(self.tmp_dir.name, "claims")
+        download, _ = DownloadCoordinator(claims_dir).claim("https://x/item")
+        claimed = []
+        for index in range(20):
+            other = threading.Thread(
+                target=lambda: claimed.append(
+                    DownloadCoordinator(claims_dir).claim(f"https://x/other{index}")
+                )
+            )
+            other.start()
+            other.join(5)
+            self.assertFalse(other.is_alive())
+        self.assertTrue(all(first for _, first in claimed))
+        self.assertEqual(len(os.listdir(claims_dir)), 21)
+        for other_download, _ in claimed:
+            other_download.finish(None)
+        download.finish(None)
+
+    def test_serial_run_downloads_without_coordinator(self):
+        """Recipes run one at a time don't claim their downloads."""
+        with patch("autopkglib.URLDownloader.get_download_coordinator") as get:
+            processor = self.run_processor("/complete")
+        get.assert_not_called()
+        self.assertTrue(processor.env["download_changed"])
+
+    def test_download_store_collects_least_recently_used(self):
+        """Objects beyond the size limit are removed oldest-first."""
+        store = DownloadStore(os.path.join(self.tmp_dir.name, "store"), 5)
+        for n, content in enumerate([b"abc", b"def"]):
+            path = os.path.join(self.tmp_dir.name, f"item{n}")
+            with open(path, "wb") as f:
+                f.write(content)
+            sha256 = hashlib.sha256(content).hexdigest()
+            with patch("time.time", return_value=1000 + n):
+                store.add(f"http://x/{n}", None, path, sha256)
+        store.collect_garbage()
+        self.assertIsNone(store.lookup("http://x/0"))
+        self.assertIsNotNone(store.lookup("http://x/1"))
+        # Objects linked elsewhere free nothing, so they aren't removed
+        os.link(store.lookup("http://x/1"), os.path.join(self.tmp_dir.name, "link"))
+        store.max_bytes = 0
+        store.collect_garbage()
+        self.assertIsNotNone(store.lookup("http://x/1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
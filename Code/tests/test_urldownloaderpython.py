@@ -0,0 +1,85 @@
+#!/usr/local/autopkg/python
+
+import http.server
+import os
+import tempfile
+import threading
+import unittest
+
+from autopkglib.URLDownloaderPython import URLDownloaderPython
+
+ETAG = '"v1"'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Serves a file that honours If-None-Match."""
+
+    protocol_version = "HTTP/1.1"
+    bodies_sent = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.send_header("ETag", ETAG)
+            self.end_headers()
+            return
+        body = b"x" * 1024
+        self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Last-Modified", "Mon, 01 Jan 2024 00:00:00 GMT")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        type(self).bodies_sent += 1
+
+
+class TestURLDownloaderPython(unittest.TestCase):
+    """Test class for URLDownloaderPython Processor."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}/item.dmg"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def run_processor(self):
+        processor = URLDownloaderPython(
+            {
+                "url": self.url,
+                "download_dir": self.tmp_dir.name,
+                "RECIPE_CACHE_DIR": self.tmp_dir.name,
+                "CHECK_FILESIZE_ONLY": False,
+                "HEADERS_TO_TEST": ["ETag", "Last-Modified", "Content-Length"],
+                "verbose": 0,
+            }
+        )
+        processor.main()
+        return processor
+
+    def test_unchanged_item_is_not_downloaded_again(self):
+        """A 304 reply to the conditional request leaves the previous
+        download in place without creating a temporary file."""
+        before = _Handler.bodies_sent
+        self.assertTrue(self.run_processor().env["download_changed"])
+        self.assertFalse(self.run_processor().env["download_changed"])
+        self.assertEqual(_Handler.bodies_sent, before + 1)
+        self.assertEqual(
+            sorted(os.listdir(self.tmp_dir.name)), ["item.dmg", "item.dmg.info.json"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
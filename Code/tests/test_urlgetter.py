@@ -0,0 +1,336 @@
+#!/usr/local/autopkg/python
+
+import http.server
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from autopkglib import ProcessorError
+from autopkglib.transport import (
+    DEFAULT_MAX_CONNECTIONS_PER_HOST,
+    DEFAULT_RETRIES,
+    PooledTransport,
+    RateLimiter,
+    ResponseCache,
+    parse_curl_cmd,
+    retry_delay,
+)
+from autopkglib.URLGetter import URLGetter
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Serves the connection id, so reuse of connections is visible."""
+
+    protocol_version = "HTTP/1.1"
+    requests = 0
+    busy = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        type(self).requests += 1
+        if self.path == "/busy" and type(self).busy:
+            # Turn away the first requests, like a rate-limiting server
+            type(self).busy -= 1
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path == "/busy":
+            self.path = "/conn"
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/conn")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path != "/conn":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = str(id(self.connection)).encode()
+        self.send_response(200)
+        self.send_header("ETag", '"1"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestURLGetter(unittest.TestCase):
+    """Test class for URLGetter's HTTP transport."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.processor = URLGetter(
+            {"CURL_PATH": "/usr/bin/curl", "HTTP_TRANSPORT": "pool"}
+        )
+
+    def test_parse_curl_cmd_maps_options(self):
+        """Options with in-process equivalents are translated."""
+        request = parse_curl_cmd(
+            [
+                "curl",
+                "--silent",
+                "--location",
+                "--header",
+                "Accept: application/json",
+                "-X",
+                "POST",
+                "-d",
+                '{"a": 1}',
+                "--url",
+                "https://example.com/api",
+            ]
+        )
+        self.assertEqual(request.url, "https://example.com/api")
+        self.assertEqual(request.method, "POST")
+        self.assertTrue(request.follow_redirects)
+        self.assertEqual(request.data, b'{"a": 1}')
+        self.assertIn(("Accept", "application/json"), request.headers)
+
+    def test_parse_curl_cmd_falls_back_to_curl(self):
+        """Unknown options and non-HTTP URLs are left to curl."""
+        self.assertIsNone(
+            parse_curl_cmd(["curl", "--retry", "3", "https://example.com/"])
+        )
+        self.assertIsNone(parse_curl_cmd(["curl", "ftp://example.com/file"]))
+        self.assertIsNone(
+            parse_curl_cmd(["curl", "-d", "@payload.json", "https://example.com/"])
+        )
+
+    def test_download_reuses_connection(self):
+        """Consecutive downloads from a host share one connection."""
+        first = self.processor.download(self.base_url + "/conn")
+        second = self.processor.download(self.base_url + "/redirect")
+        self.assertEqual(first, second)
+
+    def test_download_to_file_dumps_headers(self):
+        """Headers are dumped like curl's, including redirects."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = os.path.join(tmp_dir, "download")
+            curl_cmd = self.processor.prepare_curl_cmd()
+            curl_cmd.extend(["--dump-header", "-", "--output", output])
+            curl_cmd.append(self.base_url + "/redirect")
+            header = self.processor.parse_headers(
+                self.processor.download_with_curl(curl_cmd)
+            )
+            self.assertTrue(os.path.getsize(output))
+        self.assertEqual(header["http_result_code"], "200")
+        self.assertEqual(header["http_redirected"], "/conn")
+        self.assertEqual(header["etag"], '"1"')
+
+    def test_fail_raises_processor_error(self):
+        """--fail turns HTTP errors into curl's exit code 22."""
+        curl_cmd = ["curl", "--fail", self.base_url + "/missing"]
+        with self.assertRaises(ProcessorError) as err:
+            self.processor.download_with_curl(curl_cmd)
+        self.assertIn("(22)", str(err.exception))
+
+    def test_response_cache_shared_between_processors(self):
+        """Processors that cache responses reuse them for the whole run."""
+        cache = ResponseCache(1024 * 1024)
+        url = self.base_url + "/conn"
+        with patch("autopkglib.URLGetter.get_response_cache", return_value=cache):
+            first = URLGetter({"CURL_PATH": "/usr/bin/curl", "HTTP_TRANSPORT": "pool"})
+            first.cache_responses = True
+            before = _Handler.requests
+            content = first.download(url)
+            second = URLGetter({"CURL_PATH": "/usr/bin/curl", "HTTP_TRANSPORT": "pool"})
+            second.cache_responses = True
+            self.assertEqual(second.download(url), content)
+            self.assertEqual(_Handler.requests, before + 1)
+            # Processors that don't opt in always make the request
+            self.processor.download(url)
+            self.assertEqual(_Handler.requests, before + 2)
+
+    @unittest.skipUnless(os.path.exists("/usr/bin/curl"), "needs curl")
+    def test_response_cache_used_with_curl(self):
+        """Responses are also cached for requests made with curl, the default
+        transport."""
+        cache = ResponseCache(1024 * 1024)
+        url = self.base_url + "/conn"
+        with patch(
+            "autopkglib.URLGetter.get_response_cache", return_value=cache
+        ), patch("autopkglib.URLGetter.get_pref", return_value=None):
+            processor = URLGetter({"CURL_PATH": "/usr/bin/curl"})
+            processor.cache_responses = True
+            self.assertIsNone(processor.http_transport())
+            before = _Handler.requests
+            content = processor.download(url, text=True)
+            self.assertTrue(content.isdigit())
+            self.assertEqual(processor.download(url, text=True), content)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                output = os.path.join(tmp_dir, "download")
+                processor.download_to_file(url, output)
+                processor.download_to_file(url, output)
+                with open(output) as f:
+                    self.assertTrue(f.read().isdigit())
+            self.assertEqual(_Handler.requests, before + 2)
+            self.assertEqual(cache.lookups(), (2, 2))
+            # Errors aren't cached
+            processor.download(self.base_url + "/missing")
+            processor.download(self.base_url + "/missing")
+            self.assertEqual(_Handler.requests, before + 4)
+
+    def test_http_transport_is_opt_in(self):
+        """Requests run curl unless HTTP_TRANSPORT asks for the pool."""
+        with patch("autopkglib.URLGetter.get_pref", return_value=None):
+            self.assertIsNone(URLGetter({}).http_transport())
+            self.assertIsNotNone(self.processor.http_transport())
+
+    def test_invalid_transport_prefs_use_defaults(self):
+        """Malformed numeric preferences fall back to their defaults."""
+        prefs = {"HTTP_MAX_CONNECTIONS_PER_HOST": "many", "HTTP_RETRIES": "-1"}
+        with patch("autopkglib.transport.get_pref", side_effect=prefs.get), patch(
+            "autopkglib.transport.log_err"
+        ):
+            transport = PooledTransport()
+        self.assertEqual(transport.pool.max_per_host, DEFAULT_MAX_CONNECTIONS_PER_HOST)
+        self.assertEqual(transport.retries, DEFAULT_RETRIES)
+
+    def test_response_cache_evicts_least_recently_used(self):
+        """Entries are evicted oldest-first once the size limit is reached."""
+        cache = ResponseCache(10)
+        requests = [parse_curl_cmd(["curl", f"http://x/{n}"]) for n in range(3)]
+        for request in requests[:2]:
+            request.status = 200
+            cache.put(request, b"1234")
+        self.assertEqual(cache.get(requests[0]), b"1234")
+        requests[2].status = 200
+        cache.put(requests[2], b"1234")
+        self.assertIsNone(cache.get(requests[1]))
+        self.assertEqual(cache.get(requests[0]), b"1234")
+        self.assertEqual(cache.size, 8)
+
+    def test_response_cache_persists_with_ttl(self):
+        """With a TTL, responses are reused by later runs until they expire."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            request = parse_curl_cmd(["curl", "http://x/feed"])
+            request.status = 200
+            ResponseCache(1024, ttl=60, cache_dir=tmp_dir).put(request, b"feed")
+            self.assertEqual(
+                ResponseCache(1024, ttl=60, cache_dir=tmp_dir).get(request), b"feed"
+            )
+            with patch("time.time", return_value=2**40):
+                expired = ResponseCache(1024, ttl=60, cache_dir=tmp_dir)
+                self.assertIsNone(expired.get(request))
+
+    def test_response_cache_removes_expired_entries_from_disk(self):
+        """Saving an entry clears out expired ones left by earlier runs."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            old = parse_curl_cmd(["curl", "http://x/old"])
+            new = parse_curl_cmd(["curl", "http://x/new"])
+            old.status = new.status = 200
+            ResponseCache(1024, ttl=60, cache_dir=tmp_dir).put(old, b"old")
+            for entry in os.scandir(tmp_dir):
+                os.utime(entry.path, (1, 1))
+            ResponseCache(1024, ttl=60, cache_dir=tmp_dir).put(new, b"new")
+            self.assertEqual(len(os.listdir(tmp_dir)), 1)
+            cache = ResponseCache(1024, ttl=60, cache_dir=tmp_dir)
+            self.assertIsNone(cache.get(old))
+            self.assertEqual(cache.get(new), b"new")
+
+    def test_retry_after_honoured(self):
+        """Requests turned away with 429 are retried when the server says."""
+        _Handler.busy = 2
+        before = _Handler.requests
+        self.assertTrue(self.processor.download(self.base_url + "/busy"))
+        self.assertEqual(_Handler.requests, before + 3)
+
+    def test_server_errors_only_retried_for_idempotent_requests(self):
+        """A 503 is retried for GET but not POST; a 429 is retried for both."""
+
+        class Response:
+            def __init__(self, status):
+                self.status = status
+
+            def getheader(self, name):
+                return None
+
+        self.assertEqual(retry_delay(Response(503), 0, "GET"), 1)
+        self.assertIsNone(retry_delay(Response(503), 0, "POST"))
+        self.assertEqual(retry_delay(Response(429), 1, "POST"), 2)
+
+    def test_curl_retries_only_get_and_head(self):
+        """curl commands get a bounded --retry by default, but only for GET
+        and HEAD requests."""
+        url = "https://example.com/"
+        retry_opts = ["--retry", "3", "--retry-max-time", "60"]
+        for curl_cmd, value, expected in (
+            (["curl", url], None, ["curl"] + retry_opts + [url]),
+            (["curl", "-I", url], "x", ["curl"] + retry_opts + ["-I", url]),
+            (["curl", url], "1", ["curl", "--retry", "1"] + retry_opts[2:] + [url]),
+            (["curl", url], "0", ["curl", url]),
+            (["curl", "-d", "a=1", url], None, ["curl", "-d", "a=1", url]),
+            (["curl", "-X", "POST", url], None, ["curl", "-X", "POST", url]),
+            (["curl", "--retry", "5", url], None, ["curl", "--retry", "5", url]),
+        ):
+            prefs = {"HTTP_RETRIES": value}
+            with patch("autopkglib.transport.get_pref", side_effect=prefs.get), patch(
+                "autopkglib.transport.log_err"
+            ), patch("autopkglib.URLGetter.get_rate_limiter"):
+                self.assertEqual(self.processor.add_curl_retry_opts(curl_cmd), expected)
+
+    def test_curl_processes_limited_per_host(self):
+        """Threads, as in a concurrent --check, run no more curl processes
+        against a host at once than the pool would open connections."""
+        lock = threading.Lock()
+        running = {"now": 0, "most": 0}
+
+        def fake_run(curl_cmd, **kwargs):
+            with lock:
+                running["now"] += 1
+                running["most"] = max(running["most"], running["now"])
+            time.sleep(0.05)
+            with lock:
+                running["now"] -= 1
+
+        prefs = {"HTTP_MAX_CONNECTIONS_PER_HOST": "2"}
+        with patch("autopkglib.transport.get_pref", side_effect=prefs.get), patch(
+            "autopkglib.transport._curl_slots", {}
+        ), patch("autopkglib.URLGetter.get_rate_limiter"), patch(
+            "autopkglib.URLGetter.subprocess.run", side_effect=fake_run
+        ):
+            threads = [
+                threading.Thread(
+                    target=self.processor.run_curl,
+                    args=(["curl", "https://example.com/"],),
+                )
+                for _ in range(6)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(running["most"], 2)
+
+    def test_rate_limiter_spaces_requests_per_host(self):
+        """Requests beyond the burst wait for tokens; other hosts don't."""
+        limiter = RateLimiter(20, burst=1)
+        start = time.monotonic()
+        for _ in range(3):
+            limiter.acquire("a.example.com")
+        limiter.acquire("b.example.com")
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertLess(time.monotonic() - start, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()